@@ -1,3 +1,11 @@
 __version__ = '0.1'
 from minja.environment import Environment
+from minja.bccache import BytecodeCache, FileSystemBytecodeCache
+from minja.astcache import ASTCache, MemoryASTCache, FileSystemASTCache
+from minja.loaders import BaseLoader, FileSystemLoader, ModuleLoader, \
+    BundleLoader, write_bundle
+from minja.fragcache import FragmentCache, MemoryFragmentCache, \
+    FileSystemFragmentCache
+from minja.renderpool import RenderPool
+from minja.incremental import IncrementalTemplate
 from minja.utils import Markup, escape
@@ -0,0 +1,72 @@
+import sys
+import argparse
+
+from environment import Environment
+from loaders import FileSystemLoader
+
+
+def compile_command(args):
+    env = Environment(autoescape=args.autoescape,
+                    trim_blocks=args.trim_blocks,
+                    lstrip_blocks=args.lstrip_blocks,
+                    minify_html=args.minify_html,
+                    loader=FileSystemLoader(args.source))
+    log = print if args.verbose else None
+    written = env.compile_templates(args.target, py_compile=args.pyc,
+                                    ignore_errors=not args.strict,
+                                    log_function=log)
+    print('compiled %d templates into %s' % (len(written), args.target))
+
+
+def bundle_command(args):
+    env = Environment(autoescape=args.autoescape,
+                    trim_blocks=args.trim_blocks,
+                    lstrip_blocks=args.lstrip_blocks,
+                    minify_html=args.minify_html,
+                    loader=FileSystemLoader(args.source))
+    errors = env.compile_bundle(args.target)
+    for name, error in sorted(errors.items()):
+        print('Could not compile "%s": %s' % (name, error))
+    print('wrote %s' % args.target)
+    return 1 if errors and args.strict else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='minja')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    compile_parser = subparsers.add_parser(
+        'compile', help='write templates as importable python modules')
+    compile_parser.add_argument('source', help='template directory')
+    compile_parser.add_argument('target', help='output directory')
+    compile_parser.add_argument('--autoescape', action='store_true')
+    compile_parser.add_argument('--trim-blocks', action='store_true')
+    compile_parser.add_argument('--lstrip-blocks', action='store_true')
+    compile_parser.add_argument('--minify-html', action='store_true')
+    compile_parser.add_argument('--pyc', action='store_true',
+                                help='also write the bytecode of the modules')
+    compile_parser.add_argument('--strict', action='store_true',
+                                help='stop at the first template that '
+                                'fails to compile')
+    compile_parser.add_argument('-v', '--verbose', action='store_true')
+    compile_parser.set_defaults(func=compile_command)
+
+    bundle_parser = subparsers.add_parser(
+        'bundle', help='write templates into a single bundle file')
+    bundle_parser.add_argument('source', help='template directory')
+    bundle_parser.add_argument('target', help='bundle file')
+    bundle_parser.add_argument('--autoescape', action='store_true')
+    bundle_parser.add_argument('--trim-blocks', action='store_true')
+    bundle_parser.add_argument('--lstrip-blocks', action='store_true')
+    bundle_parser.add_argument('--minify-html', action='store_true')
+    bundle_parser.add_argument('--strict', action='store_true',
+                            help='exit with an error if any template '
+                            'fails to compile')
+    bundle_parser.set_defaults(func=bundle_command)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""Caches the parsed trees of templates as marshalled tagged tuples, so
+tools and recompiles with other options skip lexing and parsing"""
+import os
+import marshal
+import tempfile
+from hashlib import sha1
+
+import nodes
+from utils import LRUCache, chmod_default
+
+# bump this whenever the nodes change in an incompatible way
+ast_version = 1
+ast_magic = b'minja-ast' + bytes([ast_version])
+
+# default number of trees kept by a `MemoryASTCache`
+DEFAULT_CAPACITY = 400
+
+
+class ASTCache:
+    """Base class for the stores of parsed templates. Keys cover the
+    source and the options that change the tree, values are the
+    marshalled trees"""
+
+    def get(self, key):
+        """Returns the marshalled tree or None"""
+        raise NotImplementedError()
+
+    def set(self, key, data):
+        raise NotImplementedError()
+
+    def clear(self):
+        """Removes every cached tree"""
+
+    def get_cache_key(self, environment, source):
+        hash = sha1(ast_magic)
+        hash.update(repr(environment.parse_options()).encode('utf-8'))
+        hash.update(source.encode('utf-8'))
+        return hash.hexdigest()
+
+    def load(self, environment, source):
+        """Returns a new copy of the cached tree of `source` or None"""
+        data = self.get(self.get_cache_key(environment, source))
+        if data is None:
+            return None
+        try:
+            return nodes.load(marshal.loads(data))
+        except (EOFError, ValueError, TypeError, KeyError, IndexError):
+            return None
+
+    def dump(self, environment, source, node):
+        self.set(self.get_cache_key(environment, source),
+                 marshal.dumps(nodes.dump(node)))
+
+
+class MemoryASTCache(ASTCache):
+    """Keeps trees in an in-process LRU cache"""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self._cache = LRUCache(capacity)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, data):
+        self._cache[key] = data
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class FileSystemASTCache(ASTCache):
+    """Stores trees as files in `directory`, by default the system's
+    temporary directory"""
+
+    def __init__(self, directory=None, pattern='__minja_%s.ast'):
+        if directory is None:
+            directory = tempfile.gettempdir()
+        self.directory = directory
+        self.pattern = pattern
+
+    def _get_filename(self, key):
+        return os.path.join(self.directory, self.pattern % key)
+
+    def get(self, key):
+        try:
+            with open(self._get_filename(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, key, data):
+        filename = self._get_filename(key)
+        # write to a temporary file first so concurrent readers never
+        # see a partially written tree
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(filename) + '.',
+                                   dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            chmod_default(tmp)
+            os.replace(tmp, filename)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def clear(self):
+        from fnmatch import fnmatch
+        pattern = self.pattern % '*'
+        for filename in os.listdir(self.directory):
+            if fnmatch(filename, pattern):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
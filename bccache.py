@@ -0,0 +1,148 @@
+import os
+import marshal
+import tempfile
+from io import BytesIO
+from hashlib import sha1
+from importlib.util import MAGIC_NUMBER
+
+import compiler
+from utils import chmod_default
+
+
+def _file_checksum(filename):
+    with open(filename, 'rb') as f:
+        return sha1(f.read()).digest()
+
+# bump this whenever the cache format changes. The checksum of the code
+# generator covers changes to the generated code and the python bytecode
+# magic takes care of interpreter upgrades
+bc_version = 1
+bc_magic = (b'minja' + bytes([bc_version]) + MAGIC_NUMBER +
+            _file_checksum(compiler.__file__))
+
+
+class Bucket:
+    def __init__(self, environment, key, checksum):
+        """Holds the compiled code of one template for a `BytecodeCache`"""
+        self.environment = environment
+        self.key = key
+        self.checksum = checksum
+        self.reset()
+
+    def reset(self):
+        self.code = None
+
+    def load_bytecode(self, f):
+        magic = f.read(len(bc_magic))
+        if magic != bc_magic:
+            self.reset()
+            return
+        checksum = f.read(len(self.checksum))
+        if checksum != self.checksum:
+            self.reset()
+            return
+        try:
+            self.code = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            self.reset()
+
+    def write_bytecode(self, f):
+        if self.code is None:
+            raise TypeError('can\'t write empty bucket')
+        f.write(bc_magic)
+        f.write(self.checksum)
+        marshal.dump(self.code, f)
+
+    def bytecode_from_string(self, string):
+        self.load_bytecode(BytesIO(string))
+
+    def bytecode_to_string(self):
+        out = BytesIO()
+        self.write_bytecode(out)
+        return out.getvalue()
+
+
+class BytecodeCache:
+    """Base class for bytecode caches. Subclasses implement
+    `load_bytecode` and `dump_bytecode` which get passed a `Bucket`"""
+
+    def load_bytecode(self, bucket):
+        raise NotImplementedError()
+
+    def dump_bytecode(self, bucket):
+        raise NotImplementedError()
+
+    def clear(self):
+        """Removes every cached template"""
+
+    def get_source_checksum(self, source):
+        return sha1(source.encode('utf-8')).digest()
+
+    def get_cache_key(self, environment, name, filename, checksum):
+        """The key covers the source checksum, the cache format and the
+        environment options that change the generated code"""
+        hash = sha1(bc_magic)
+        hash.update(repr(environment.compile_options()).encode('utf-8'))
+        hash.update(repr((name, filename)).encode('utf-8'))
+        hash.update(checksum)
+        return hash.hexdigest()
+
+    def get_bucket(self, environment, name, filename, source):
+        checksum = self.get_source_checksum(source)
+        key = self.get_cache_key(environment, name, filename, checksum)
+        bucket = Bucket(environment, key, checksum)
+        self.load_bytecode(bucket)
+        return bucket
+
+    def set_bucket(self, bucket):
+        self.dump_bytecode(bucket)
+
+
+class FileSystemBytecodeCache(BytecodeCache):
+    """Stores marshalled templates as files in `directory`, by default
+    the system's temporary directory"""
+
+    def __init__(self, directory=None, pattern='__minja_%s.cache'):
+        if directory is None:
+            directory = tempfile.gettempdir()
+        self.directory = directory
+        self.pattern = pattern
+
+    def _get_cache_filename(self, bucket):
+        return os.path.join(self.directory, self.pattern % bucket.key)
+
+    def load_bytecode(self, bucket):
+        try:
+            f = open(self._get_cache_filename(bucket), 'rb')
+        except OSError:
+            return
+        with f:
+            bucket.load_bytecode(f)
+
+    def dump_bytecode(self, bucket):
+        filename = self._get_cache_filename(bucket)
+        # write to a temporary file first so concurrent readers never
+        # see a partially written cache file
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(filename) + '.',
+                                   dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            chmod_default(tmp)
+            os.replace(tmp, filename)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def clear(self):
+        from fnmatch import fnmatch
+        pattern = self.pattern % '*'
+        for filename in os.listdir(self.directory):
+            if fnmatch(filename, pattern):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
@@ -0,0 +1,363 @@
+"""Micro benchmarks, run with `python bench.py [name ...]`"""
+import os
+import sys
+import time
+import tempfile
+import threading
+import tracemalloc
+
+import nodes
+from environment import Environment
+from loaders import FileSystemLoader
+
+benchmarks = {}
+
+
+def benchmark(func):
+    benchmarks[func.__name__] = func
+    return func
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    rv = func(*args, **kwargs)
+    return time.perf_counter() - start, rv
+
+
+def best_of(func, repeat=5):
+    """Best wall time of `repeat` runs of `func`"""
+    return min(timed(func)[0] for _ in range(repeat))
+
+
+def private_dirty_kb():
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Private_Dirty:'):
+                return int(line.split()[1])
+
+
+def write_templates(directory, count):
+    with open(os.path.join(directory, 'base.html'), 'w') as f:
+        f.write('<html>{% block body %}{% endblock %}</html>')
+    for i in range(count):
+        with open(os.path.join(directory, 'page%d.html' % i), 'w') as f:
+            f.write('{% extends "base.html" %}{% block body %}' +
+                    '{% for row in rows %}<p>{{ row }} {{ title }}</p>'
+                    '{% endfor %}' * 20 + '{% endblock %}')
+
+
+@benchmark
+def preload(templates=300, workers=4):
+    """Private dirty memory of forked workers rendering every template,
+    compiling them in each worker vs. `Environment.preload` in the parent"""
+    directory = tempfile.mkdtemp()
+    write_templates(directory, templates)
+
+    def run(use_preload):
+        env = Environment(loader=FileSystemLoader(directory),
+                        cache_size=templates + 1)
+        names = env.loader.list_templates()
+        if use_preload:
+            env.preload(names)
+        results = []
+        for _ in range(workers):
+            read, write = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read)
+                before = private_dirty_kb()
+                for _ in range(3):
+                    for name in names:
+                        env.get_template(name).render(rows=range(3), title='x')
+                os.write(write, str(private_dirty_kb() - before).encode())
+                os._exit(0)
+            os.close(write)
+            with os.fdopen(read) as f:
+                results.append(int(f.read()))
+            os.waitpid(pid, 0)
+        if use_preload:
+            import gc
+            gc.unfreeze()
+        return sum(results) / len(results)
+
+    print('templates: %d, workers: %d' % (templates, workers))
+    print('  without preload: %8.0f KiB dirtied per worker' % run(False))
+    print('  with preload:    %8.0f KiB dirtied per worker' % run(True))
+
+
+@benchmark
+def render_many(recipients=20000):
+    """Rendering one template for many contexts, plain loop of `render`
+    vs. `render_many`"""
+    env = Environment(autoescape=True)
+    template = env.from_string('Hello {{ name }},\n'
+                            '{% for item in items %}- {{ item }}\n{% endfor %}'
+                            'Regards, {{ sender }}')
+    contexts = [{'name': 'user%d' % i, 'items': ('a', 'b', 'c'),
+                'sender': 'minja'} for i in range(recipients)]
+
+    loop = best_of(lambda: [template.render(c) for c in contexts])
+    many = best_of(lambda: list(template.render_many(contexts)))
+    print('recipients: %d' % recipients)
+    print('  render loop: %6.3fs (%8.0f renders/s)' % (loop, recipients / loop))
+    print('  render_many: %6.3fs (%8.0f renders/s)' % (many, recipients / many))
+
+
+@benchmark
+def render_columns(rows=100000):
+    """Row template over dict-of-lists columns, `render_many` over one
+    dict per row vs. the columnar `render_columns`"""
+    env = Environment(autoescape=True)
+    template = env.from_string('<tr><td>{{ id }}</td><td>{{ name }}</td>'
+                            '<td>{{ score }}</td></tr>')
+    columns = {
+        'id': list(range(rows)),
+        'name': ['<user %d>' % i for i in range(rows)],
+        'score': [i * 0.5 for i in range(rows)],
+    }
+    records = [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+    scalar = best_of(lambda: list(template.render_many(records)), 3)
+    columnar = best_of(lambda: template.render_columns(columns), 3)
+    print('rows: %d' % rows)
+    print('  render_many:    %6.3fs (%9.0f rows/s)' % (scalar, rows / scalar))
+    print('  render_columns: %6.3fs (%9.0f rows/s)' % (columnar,
+                                                    rows / columnar))
+    try:
+        import numpy
+    except ImportError:
+        return
+    columns['id'] = numpy.arange(rows)
+    columns['score'] = numpy.arange(rows) * 0.5
+    columnar = best_of(lambda: template.render_columns(columns), 3)
+    print('  with numpy:     %6.3fs (%9.0f rows/s)' % (columnar,
+                                                    rows / columnar))
+
+
+@benchmark
+def threads(templates=50, renders=20000):
+    """Render throughput of one shared environment by thread count, the
+    caches start out cold so the threads race to compile"""
+    directory = tempfile.mkdtemp()
+    write_templates(directory, templates)
+    names = ['page%d.html' % i for i in range(templates)]
+
+    for count in (1, 2, 4, 8, 16, 32, 64):
+        env = Environment(loader=FileSystemLoader(directory),
+                        cache_size=templates + 1)
+        compiled = []
+        compile = env.compile
+        env.compile = lambda *args: compiled.append(args[1]) or compile(*args)
+        barrier = threading.Barrier(count)
+        per_thread = renders // count
+
+        def work(offset):
+            barrier.wait()
+            for i in range(per_thread):
+                name = names[(offset + i) % templates]
+                env.get_template(name).render(rows=range(2), title='x')
+
+        workers = [threading.Thread(target=work, args=(i,))
+                for i in range(count)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        print('  %2d threads: %8.0f renders/s, %d compiles' % (
+            count, per_thread * count / elapsed, len(compiled)))
+
+
+@benchmark
+def render_pool(documents=20000):
+    """Bulk rendering in this process vs. a `RenderPool`"""
+    from renderpool import RenderPool
+    directory = tempfile.mkdtemp()
+    write_templates(directory, 1)
+    env = Environment(loader=FileSystemLoader(directory))
+    template = env.get_template('page0.html')
+    contexts = [{'rows': range(3), 'title': 'doc %d' % i}
+                for i in range(documents)]
+
+    serial, _ = timed(lambda: list(template.render_many(contexts)))
+    print('documents: %d' % documents)
+    print('  render_many: %6.3fs (%8.0f docs/s)' % (serial, documents / serial))
+    with RenderPool(env, ['page0.html']) as pool:
+        pooled, _ = timed(lambda: list(pool.render('page0.html', contexts)))
+        print('  RenderPool (%d processes): %6.3fs (%8.0f docs/s)' % (
+            pool.processes, pooled, documents / pooled))
+
+
+EXPRESSION_TEMPLATE = '''
+<table>
+{% for row in rows %}
+  <tr class="{{ row.kind }}">
+    <td>{{ row.id }}</td><td>{{ row['name'] }}</td>
+    <td>{{ format(row.price, digits=2, currency='EUR') }}</td>
+    <td>{{ (row.qty, row.unit, [1, 2, 3], {'a': row.a}) }}</td>
+    {% if row.qty > 10 and row.flag %}<td>{{ -row.discount }}</td>{% endif %}
+  </tr>
+{% endfor %}
+</table>
+'''
+
+
+@benchmark
+def lexer(copies=200):
+    """Tokens per second on an expression heavy template"""
+    env = Environment()
+    source = EXPRESSION_TEMPLATE * copies
+    count = len(list(env.tokenize(source)))
+    elapsed = best_of(lambda: list(env.tokenize(source)))
+    print('  %d tokens in %.3fs, %8.0f tokens/s' % (count, elapsed,
+                                                   count / elapsed))
+
+
+@benchmark
+def parser(copies=200):
+    """Expression nodes parsed per second, not counting the lexing"""
+    env = Environment()
+    source = EXPRESSION_TEMPLATE.replace(
+        '  </tr>', '    <td>{{ row.price * row.qty - row.discount / 2 + 1 }}'
+        '</td>\n    {% if not row.hidden and (row.qty >= 1 or row.kind in '
+        'kinds) %}*{% endif %}\n  </tr>') * copies
+    count = sum(1 for node in env.parse(source).find_all(nodes.Expr))
+    lexing = best_of(lambda: env.tokenize(source))
+    elapsed = best_of(lambda: env.parse(source)) - lexing
+    print('  %d nodes in %.3fs, %8.0f nodes/s' % (count, elapsed,
+                                                 count / elapsed))
+
+
+@benchmark
+def ast_cache(copies=200):
+    """Time to get the tree of an expression heavy template by parsing
+    and from the in-memory and file system AST caches"""
+    from astcache import MemoryASTCache, FileSystemASTCache
+    source = EXPRESSION_TEMPLATE * copies
+    elapsed = best_of(lambda: Environment().parse(source))
+    print('  %-10s %8.1f ms' % ('parse', elapsed * 1000))
+    with tempfile.TemporaryDirectory() as directory:
+        for label, cache in (('memory', MemoryASTCache()),
+                             ('filesystem', FileSystemASTCache(directory))):
+            env = Environment(ast_cache=cache)
+            env.parse(source)
+            elapsed = best_of(lambda: env.parse(source))
+            print('  %-10s %8.1f ms' % (label, elapsed * 1000))
+
+
+@benchmark
+def lexer_static(size_mb=4):
+    """MB per second on a large, mostly static template"""
+    env = Environment()
+    chunk = ('<p class="body">{ plain text, no tags here }</p>\n' * 200 +
+             '{{ item.name }}\n')
+    source = chunk * (size_mb * 2 ** 20 // len(chunk))
+    elapsed = best_of(lambda: list(env.tokenize(source)))
+    print('  %.1f MB in %.3fs, %8.1f MB/s' % (len(source) / 2 ** 20, elapsed,
+                                              len(source) / 2 ** 20 / elapsed))
+
+
+@benchmark
+def lexer_chunked(size_mb=16):
+    """Time and peak memory lexing a large template from a string and
+    from a file"""
+    env = Environment()
+    chunk = ('<p>{ static text }</p>\n' * 400 + '{{ item.name }}\n')
+    with tempfile.TemporaryFile('w+') as f:
+        f.write(chunk * (size_mb * 2 ** 20 // len(chunk)))
+        for label in ('str', 'file'):
+            def lex():
+                f.seek(0)
+                source = f.read() if label == 'str' else f
+                return sum(1 for _ in env.lexer.tokenizer(source))
+            elapsed, count = timed(lex)
+            tracemalloc.start()
+            lex()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('  %-4s %d tokens in %.2fs, peak %7.1f MiB' % (
+                label, count, elapsed, peak / 2 ** 20))
+
+
+@benchmark
+def incremental(sections=2000):
+    """Latency of a one character edit in a large template, recompiled
+    from scratch and incrementally"""
+    from incremental import IncrementalTemplate
+    env = Environment()
+    section = ('<h2>{{ title }}</h2>\n'
+               '{% for row in rows %}\n  <p>{{ row.name }}</p>\n{% endfor %}\n'
+               '{% block b%d %}\n  <div>{{ footer }}</div>\n{% endblock %}\n')
+    source = ''.join(section.replace('%d', str(i)) for i in range(sections))
+    print('  %d lines' % source.count('\n'))
+    elapsed = best_of(lambda: env.compile(source), repeat=3)
+    print('  full compile         %8.1f ms' % (elapsed * 1000))
+    doc = IncrementalTemplate(env, source)
+    for label, needle in (('edit in a block', '<div>'),
+                          ('edit at top level', '<h2>')):
+        pos = doc.source.rindex(needle, 0, len(doc.source) // 2) + 1
+        elapsed = best_of(lambda: (doc.edit(pos, pos, 'x'),
+                                   doc.edit(pos, pos + 1, '')), repeat=5)
+        print('  %-20s %8.1f ms' % (label, elapsed / 2 * 1000))
+
+
+@benchmark
+def whitespace(rows=20000):
+    """Output size and render time of an indented loop, with the
+    whitespace around tags kept and stripped while lexing"""
+    source = ('<table>\n'
+              '  {% for row in rows %}\n'
+              '    {% if row.visible %}\n'
+              '    <tr>\n'
+              '      {% for cell in row.cells %}\n'
+              '      <td>{{ cell }}</td>\n'
+              '      {% endfor %}\n'
+              '    </tr>\n'
+              '    {% endif %}\n'
+              '  {% endfor %}\n'
+              '</table>\n')
+    data = [{'visible': True, 'cells': [1, 2, 3, 4]}] * rows
+    for label, options in (('kept', {}),
+                           ('trimmed', dict(trim_blocks=True,
+                                            lstrip_blocks=True))):
+        template = Environment(**options).from_string(source)
+        output = template.render(rows=data)
+        elapsed = best_of(lambda: template.render(rows=data))
+        print('  %-8s %8.1f KiB in %.3fs' % (label, len(output) / 1024,
+                                              elapsed))
+
+
+@benchmark
+def minify_html(rows=20000):
+    """Output size and render time of an indented HTML page with and
+    without minifying its static data at compile time"""
+    source = ('<!DOCTYPE html>\n'
+              '<html>\n'
+              '  <body>\n'
+              '    <!-- one row per record -->\n'
+              '    <table class="records">\n'
+              '{% for row in rows %}\n'
+              '      <tr class="record">\n'
+              '        <td class="name">   {{ row.name }}   </td>\n'
+              '        <td class="value">  {{ row.value }}  </td>\n'
+              '      </tr>\n'
+              '{% endfor %}\n'
+              '    </table>\n'
+              '    <pre>\n  generated   by minja\n    </pre>\n'
+              '  </body>\n'
+              '</html>\n')
+    data = [{'name': 'row %d' % i, 'value': i} for i in range(rows)]
+    for label, options in (('kept', {}), ('minified', dict(minify_html=True))):
+        env = Environment(**options)
+        elapsed = best_of(lambda: env.compile(source))
+        template = env.from_string(source)
+        output = template.render(rows=data)
+        render = best_of(lambda: template.render(rows=data))
+        print('  %-8s %8.1f KiB in %.3fs, compiled in %.2f ms' % (
+            label, len(output) / 1024, render, elapsed * 1000))
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or benchmarks:
+        print('== %s' % name)
+        benchmarks[name]()
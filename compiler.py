@@ -5,6 +5,7 @@ from idtracking import (Symbols, VAR_LOAD_PARAM, VAR_LOAD_RESOLVE,
 from visitor import NodeVisitor
 from utils import escape, concat
 from io import StringIO
+from hashlib import sha1
 
 operators = {
     'eq':       '==',
@@ -25,6 +26,49 @@ def generate(node, environment, name, stream=None):
     if stream is None:
         return generator.stream.getvalue()
 
+def template_checksum(node, environment):
+    """Returns a checksum of the tree of a template and the options it's
+    compiled with. Fragment cache keys contain it, as templates from
+    strings share the name None and environments may share a cache"""
+    hash = sha1(repr(environment.compile_options()).encode('utf-8'))
+    hash.update(repr(nodes.dump(node)).encode('utf-8'))
+    return hash.hexdigest()
+
+def output_const(node, eval_ctx):
+    """Returns the string an output node renders to if it's constant,
+    raises `Impossible` otherwise"""
+    const = node.as_const(eval_ctx)
+    try:
+        if eval_ctx.autoescape:
+            if hasattr(const, '__html__'):
+                const = const.__html__()
+            else:
+                const = escape(const)
+        return str(const)
+    except Exception:
+        raise nodes.Impossible()
+
+def columnar_plan(node, eval_ctx):
+    """Returns the template as a list of `(is_name, value)` segments if
+    its output only depends on plain names, None otherwise"""
+    plan = []
+    for child in node.body:
+        if not isinstance(child, nodes.Output):
+            return None
+        for item in child.nodes:
+            if isinstance(item, nodes.Name) and item.ctx == 'load':
+                plan.append((True, item.name))
+                continue
+            try:
+                const = output_const(item, eval_ctx)
+            except nodes.Impossible:
+                return None
+            if plan and not plan[-1][0]:
+                plan[-1] = (False, plan[-1][1] + const)
+            else:
+                plan.append((False, const))
+    return plan
+
 def find_undeclared(nodes, names):
     visitor = UndeclaredNameVisitor(names)
     for node in nodes:
@@ -77,10 +121,13 @@ class CodeGenerator(NodeVisitor):
         if stream is None:
             stream = StringIO()
         self.environment = environment
+        self.is_async = environment.is_async
         self.stream = stream
         self.code_lineno = 1
         self.blocks = {}
         self.name = name
+        # set for templates with cache tags
+        self.checksum = None
         self._first_write = True
         self._new_lines = self._indentation = 0
         self._last_identifier = 0
@@ -143,8 +190,24 @@ class CodeGenerator(NodeVisitor):
                 self.writeline('%s = missing' % ' = '.join(undefs))
 
     def func(self, name):
+        if self.is_async:
+            return 'async def {}'.format(name)
         return 'def {}'.format(name)
 
+    def choose_async(self, async_value='async ', sync_value=''):
+        return async_value if self.is_async else sync_value
+
+    def yield_from(self, expr):
+        """Writes a delegation to another render generator, async
+        generators can't `yield from`"""
+        if self.is_async:
+            self.writeline('async for event in %s:' % expr)
+            self.indent()
+            self.writeline('yield event')
+            self.outdent()
+        else:
+            self.writeline('yield from %s' % expr)
+
     def get_resolve_func(self):
         return 'resolve'
 
@@ -177,52 +240,96 @@ class CodeGenerator(NodeVisitor):
         eval_ctx = EvalContext(self.environment, self.name)
         # TODO: Write runtime imports
 
-        from runtime import __all__ as exported
-        self.writeline('from runtime import %s' % ', '.join(exported))
         for block in node.find_all(nodes.Block):
             if block.name in self.blocks:
                 self.fail('block %r defined twice' % 
                         block.name, block.lineno, self.name)
             self.blocks[block.name] = block
 
+        if node.find(nodes.Cache) is not None:
+            self.checksum = template_checksum(node, self.environment)
+        self.write_imports()
         self.writeline('name = %r' % self.name)
 
-        # write root render function for this template
+        # a single top level extends with a constant name is resolved
+        # when the template is loaded: the parent's root function and the
+        # merged block table replace this template's root, so rendering
+        # an inherited template costs the same as rendering a flat one
+        static_extends = None
+        extends = list(node.find_all(nodes.Extends))
+        if (len(extends) == 1 and extends[0] in node.body and
+            isinstance(extends[0].template, nodes.Const)):
+            static_extends = extends[0].template.value
+            self.writeline('extends = %r' % static_extends)
+
+        self.write_root(node, eval_ctx, static_extends)
+        for block in self.blocks.values():
+            self.write_block(block, eval_ctx)
+        self.write_block_table()
+        self.write_columnar(node, eval_ctx)
+
+    # the writers below are also used on their own to regenerate single
+    # functions of a template that is recompiled piece by piece
+
+    def write_imports(self):
+        from runtime import __all__ as exported
+        self.writeline('from runtime import %s' % ', '.join(exported))
+
+    def write_root(self, node, eval_ctx, static_extends=None):
+        """Writes the root render function of the template `node`"""
         self.writeline('%s(context, missing=missing, environment=environment):' %
                         (self.func('root')), extra=1)
         self.indent()
         self.write_commons()
 
-        frame = Frame(eval_ctx)
-        frame.symbols.analyze_node(node)
-        # frame.toplever = frame.rootlevel = True
-        # TODO: resolve extends output checks
-        self.enter_frame(frame)
-        self.blockvisit(node.body, frame)
-        self.leave_frame(frame, keep_scope=True)
+        if static_extends is None:
+            frame = Frame(eval_ctx)
+            frame.symbols.analyze_node(node)
+            # frame.toplever = frame.rootlevel = True
+            self.enter_frame(frame)
+            self.blockvisit(node.body, frame)
+            self.leave_frame(frame, keep_scope=True)
         self.outdent()
 
-        # TODO: yield from parent templates if have_extends
-        # visit blocks
-        for name, block in self.blocks.items():
-            self.writeline('%s(context, missing=missing, environment=environment):' %
-                            (self.func('block_' + name)), block, 1)
-            self.indent()
-            self.write_commons()
-            block_frame = Frame(eval_ctx)
-            block_frame.symbols.analyze_node(block)
-            block_frame.block = name
-            self.enter_frame(block_frame)
-            self.blockvisit(block.body, block_frame)
-            self.leave_frame(block_frame, keep_scope=True)
-            self.outdent()
+    def write_block(self, block, eval_ctx):
+        """Writes the render function of a block"""
+        self.writeline('%s(context, missing=missing, environment=environment):' %
+                        (self.func('block_' + block.name)), block, 1)
+        self.indent()
+        self.write_commons()
+        block_frame = Frame(eval_ctx)
+        block_frame.symbols.analyze_node(block)
+        block_frame.block = block.name
+        self.enter_frame(block_frame)
+        self.blockvisit(block.body, block_frame)
+        self.leave_frame(block_frame, keep_scope=True)
+        self.outdent()
 
+    def write_block_table(self):
         self.writeline('blocks = {%s}' % ', '.join('%r: block_%s' % (x, x)
                         for x in self.blocks), extra=1)
+
+    def write_columnar(self, node, eval_ctx):
+        plan = columnar_plan(node, eval_ctx)
+        if plan is not None:
+            self.writeline('columnar = %r' % plan)
     
+    def visit_Extends(self, node, frame):
+        # extends that can't be resolved at load time look the parent
+        # up while rendering, blocks of this template take precedence
+        self.writeline('parent_template = environment.get_template(', node)
+        self.visit(node.template, frame)
+        self.write(')')
+        self.writeline('for name, parent_block in '
+                        'parent_template.blocks.items():')
+        self.indent()
+        self.writeline('context.blocks.setdefault(name, parent_block)')
+        self.outdent()
+        self.yield_from('parent_template.root_render_func(context)')
+        self.writeline('return')
+
     def visit_Block(self, node, frame):
-        self.writeline('yield from context.blocks[%r](%s)' % (
-                        node.name, 'context'))
+        self.yield_from('context.blocks[%r](%s)' % (node.name, 'context'))
     
     def visit_For(self, node, frame):
         # print('visit_For:', frame.symbols.loads)
@@ -239,12 +346,12 @@ class CodeGenerator(NodeVisitor):
             self.writeline('%s(fiter):' % self.func(loop_filter_func))
             self.indent()
             self.enter_frame(test_frame)
-            self.writeline('for ')
+            self.writeline(self.choose_async('async for ', 'for '))
             self.visit(node.target, loop_frame)
             self.write(' in fiter:')
             self.indent()
             self.writeline('if ')
-            self.visit(node.test)
+            self.visit(node.test, test_frame)
             self.write(':')
             self.indent()
             self.writeline('yield ')
@@ -256,12 +363,16 @@ class CodeGenerator(NodeVisitor):
             iter_indicator = self.temporary_identifier()
             self.writeline('%s = 1' % iter_indicator)
 
-        self.writeline('for ')
+        self.writeline(self.choose_async('async for ', 'for '))
         self.visit(node.target, loop_frame)
         self.write(' in ')
         if node.test:
             self.write('%s(' % loop_filter_func)
+        if self.is_async:
+            self.write('auto_aiter(')
         self.visit(node.iter, frame)
+        if self.is_async:
+            self.write(')')
         if node.test:
             self.write(')')
         self.write(':')
@@ -302,6 +413,40 @@ class CodeGenerator(NodeVisitor):
             self.blockvisit(node.else_, if_frame)
             self.outdent()
 
+    def visit_Cache(self, node, frame):
+        # the body is rendered by a nested generator which only runs
+        # when the fragment isn't cached yet
+        body_func = self.temporary_identifier()
+        key = self.temporary_identifier()
+        fragment = self.temporary_identifier()
+        self.writeline('%s():' % self.func(body_func), node)
+        self.indent()
+        self.writeline('if 0: yield None')
+        self.blockvisit(node.body, frame)
+        self.outdent()
+        self.writeline('%s = (%r, %r, %d, fragment_key(' % (
+            key, self.name, self.checksum, node.lineno))
+        self.visit(node.key, frame)
+        self.write('))')
+        self.writeline('%s = environment.fragment_cache.get(%s)' %
+                        (fragment, key))
+        self.writeline('if %s is None:' % fragment)
+        self.indent()
+        if self.is_async:
+            self.writeline('%s = concat([event async for event in %s()])' %
+                            (fragment, body_func))
+        else:
+            self.writeline('%s = concat(%s())' % (fragment, body_func))
+        self.writeline('environment.fragment_cache.set(%s, %s, ' %
+                        (key, fragment))
+        if node.timeout is not None:
+            self.visit(node.timeout, frame)
+        else:
+            self.write('None')
+        self.write(')')
+        self.outdent()
+        self.writeline('yield %s' % fragment)
+
     def visit_With(self, node, frame):
         with_frame = frame.inner()
         with_frame.symbols.analyze_node(node)
@@ -318,22 +463,11 @@ class CodeGenerator(NodeVisitor):
         body = []
         for child in node.nodes:
             try:
-                const = child.as_const(frame.eval_ctx)
+                const = output_const(child, frame.eval_ctx)
             except nodes.Impossible:
                 body.append(child)
                 continue
             
-            try:
-                if frame.eval_ctx.autoescape:
-                    if hasattr(const, '__html__'):
-                        const = const.__html__()
-                    else:
-                        const = escape(const)
-                const = str(const)
-            except Exception:
-                body.append(child)
-                continue
-            
             if body and isinstance(body[-1], list):
                 body[-1].append(const)
             else:
@@ -411,7 +545,7 @@ class CodeGenerator(NodeVisitor):
 
     def visit_Dict(self, node, frame):
         self.write('{')
-        for idx, item in enumerate(node.items()):
+        for idx, item in enumerate(node.items):
             if idx:
                 self.write(', ')
             self.visit(item.key, frame)
@@ -422,9 +556,9 @@ class CodeGenerator(NodeVisitor):
     def binop(operator):
         def visitor(self, node, frame):
             self.write('(')
-            self.visit(node.left)
+            self.visit(node.left, frame)
             self.write(' %s ' % operator)
-            self.visit(node.right)
+            self.visit(node.right, frame)
             self.write(')')
         return visitor
 
@@ -487,10 +621,14 @@ class CodeGenerator(NodeVisitor):
             self.visit(node.step, frame)
 
     def visit_Call(self, node, frame):
+        if self.is_async:
+            self.write('(await auto_await(')
         self.write('context.call(')
         self.visit(node.node, frame)
         self.signature(node, frame)
         self.write(')')
+        if self.is_async:
+            self.write('))')
 
     def visit_Keyword(self, node, frame):
         self.write(node.key + '=')
@@ -1,21 +1,136 @@
+import gc
+import os
+import asyncio
+import threading
 import sys
+import time
+import marshal
+from collections import deque
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from lexer import TemplateSyntaxError
 from parser import Parser
 from lexer import Lexer
 from compiler import generate
-from utils import concat
-from runtime import new_context, Undefined
+from minifier import minify
+from utils import concat, escape, LRUCache
+from runtime import new_context, Context, Undefined
+from nodes import EvalContext, Node
+from exceptions import TemplateError, TemplateRuntimeError
+from fragcache import MemoryFragmentCache
+
+# default number of compiled templates kept by an environment
+DEFAULT_CACHE_SIZE = 400
+# default number of seconds between two freshness checks of a template
+DEFAULT_CHECK_INTERVAL = 1.0
+# default number of characters a template stream gathers per chunk
+DEFAULT_STREAM_BUFFER_SIZE = 8192
+# number of chunks a template stream hands to a single vectored write
+STREAM_WRITE_BATCH = 16
+
+# types of values that render the same with and without escaping
+_unescaped_types = {int, float, bool}
+
+_spontaneous_environments = {}
+
+
+def get_spontaneous_environment(**options):
+    """Returns a shared environment for the given options, used by
+    templates created through the `Template` constructor"""
+    key = tuple(sorted(options.items()))
+    env = _spontaneous_environments.get(key)
+    if env is None:
+        env = _spontaneous_environments.setdefault(key, Environment(**options))
+    return env
+
+
+def _compile_worker(options, name, source, filename):
+    """Compiles one template in a worker process of `compile_many`, code
+    objects can't be pickled so they are sent back marshalled"""
+    try:
+        env = Environment(**options)
+        code = env.compile(source, name, filename)
+        if code is None:
+            return name, None, 'TemplateError: template could not be compiled'
+        return name, marshal.dumps(code), None
+    except Exception as e:
+        return name, None, '%s: %s' % (e.__class__.__name__, e)
+
+
+def _format_column(column, autoescape):
+    """Converts a whole column of values to (escaped) strings"""
+    dtype = getattr(column, 'dtype', None)
+    if dtype is not None and dtype.kind in 'biuf':
+        # numpy formats numbers in bulk and they never need escaping
+        return column.astype(str).tolist()
+    if not autoescape:
+        return list(map(str, column))
+    types = set(map(type, column))
+    if types <= _unescaped_types:
+        return list(map(str, column))
+    if types == {str}:
+        # escape the column as one string instead of value by value
+        joined = '\x00'.join(column)
+        if joined.count('\x00') == len(column) - 1:
+            return str(escape(joined)).split('\x00')
+    return list(map(escape, column))
+
+
+def create_cache(size):
+    if not size:
+        return None
+    return LRUCache(size)
 
 
 class Environment:
-    def __init__(self, autoescape=False):
+    def __init__(self, autoescape=False, cache_size=DEFAULT_CACHE_SIZE,
+                bytecode_cache=None, loader=None, auto_reload=True,
+                check_interval=DEFAULT_CHECK_INTERVAL, enable_async=False,
+                fragment_cache=None, trim_blocks=False, lstrip_blocks=False,
+                minify_html=False, ast_cache=None):
         self.autoescape = autoescape
+        self.is_async = enable_async
+        self.trim_blocks = trim_blocks
+        self.lstrip_blocks = lstrip_blocks
+        self.minify_html = minify_html
         self.lexer = Lexer(self)
         self.undefined = Undefined
+        self.cache = create_cache(cache_size)
+        self.bytecode_cache = bytecode_cache
+        self.ast_cache = ast_cache
+        self.loader = loader
+        self.auto_reload = auto_reload
+        self.check_interval = check_interval
+        self.preloaded = None
+        self._load_locks = {}
+        self._load_locks_lock = threading.Lock()
+        if fragment_cache is None:
+            fragment_cache = MemoryFragmentCache()
+        self.fragment_cache = fragment_cache
+
+    def parse_options(self):
+        """Returns the options that change the tree a template is parsed
+        into, used to key the AST cache"""
+        return (('trim_blocks', self.trim_blocks),
+                ('lstrip_blocks', self.lstrip_blocks),
+                ('minify_html', self.minify_html))
+
+    def compile_options(self):
+        """Returns the options that change the code generated for a
+        template, used to key the bytecode cache"""
+        return (('autoescape', self.autoescape),
+                ('enable_async', self.is_async)) + self.parse_options()
+
+    def cache_stats(self):
+        """Returns the hit, miss and eviction counters of the template cache"""
+        if self.cache is None:
+            return None
+        return self.cache.stats()
 
     def handle_exception(self, exc_info, source_hint=None):
-        pass
+        """Called with the syntax error of a template, re-raises it"""
+        raise exc_info[1].with_traceback(exc_info[2])
 
     def getitem(self, obj, argument):
         try:
@@ -39,13 +154,98 @@ class Environment:
             return self.undefined(obj=obj, name=attribute)
 
     def from_string(self, source):
-        return Template.from_code(self, self.compile(source))
+        # the source itself is the key, its hash is cached by python
+        # so repeated lookups don't rehash the template
+        cache = self.cache
+        if cache is not None:
+            rv = cache.get(source)
+            if rv is not None:
+                return rv
+        return self._load_once(source, None, lambda: Template.from_code(
+            self, self.load_code(source)))
     
+    def get_template(self, name):
+        """Loads a template by name through the loader. Cached templates
+        are checked for changes at most every `check_interval` seconds,
+        stale ones are recompiled and swapped in while renders already
+        in progress keep using the old template"""
+        if self.preloaded is not None:
+            template = self.preloaded.get(name)
+            if template is not None:
+                return template
+        cache = self.cache
+        key = (self.loader, name)
+        template = None
+        if cache is not None:
+            template = cache.get(key)
+            if template is not None and (not self.auto_reload or
+                                         template.is_up_to_date):
+                return template
+        if self.loader is None:
+            raise TypeError('no loader for this environment specified')
+        return self._load_once(key, template,
+                            lambda: self.loader.load(self, name))
+
+    def _load_once(self, key, stale, load):
+        """Calls `load` for a missing or `stale` cache entry and caches the
+        result. Threads missing the same key wait for the first one to
+        finish instead of compiling the template again, other keys aren't
+        blocked"""
+        cache = self.cache
+        if cache is None:
+            return load()
+        # the lock is shared with a count of the threads using it, it's
+        # only dropped once the last of them is done
+        with self._load_locks_lock:
+            entry = self._load_locks.get(key)
+            if entry is None:
+                # reentrant so a template extending itself fails with a
+                # recursion error instead of a deadlock
+                entry = self._load_locks[key] = [threading.RLock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                rv = cache.peek(key)
+                if rv is None or rv is stale:
+                    rv = load()
+                    cache[key] = rv
+                return rv
+        finally:
+            with self._load_locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._load_locks[key]
+
+    def load_code(self, source, name=None, filename=None):
+        """Compiles `source`, going through the bytecode cache if
+        one is configured"""
+        bcc = self.bytecode_cache
+        if bcc is None:
+            return self.compile(source, name, filename)
+        bucket = bcc.get_bucket(self, name, filename, source)
+        code = bucket.code
+        if code is None:
+            code = self.compile(source, name, filename)
+            if code is not None:
+                bucket.code = code
+                bcc.set_bucket(bucket)
+        return code
+
     def tokenize(self, source):
         return self.lexer.tokenize(source)
 
     def _parse(self, source, name, filename):
-        return Parser(self, source).parse()
+        cache = self.ast_cache
+        if cache is not None and isinstance(source, str):
+            node = cache.load(self, source)
+            if node is not None:
+                return node
+        node = Parser(self, source).parse()
+        if self.minify_html:
+            minify(node.body)
+        if cache is not None and isinstance(source, str):
+            cache.dump(self, source, node)
+        return node
 
     def parse(self, source, name=None, filename=None):
         try:
@@ -57,15 +257,19 @@ class Environment:
     def _generate(self, node, name, filename):
         return generate(node, self, name)
 
-    def compile(self, source, name=None, filename=None):
+    def compile(self, source, name=None, filename=None, raw=False):
+        """Compiles a template source or node, returns the python source
+        instead of a code object if `raw` is set. The source may also be
+        a file object or mmap which is lexed in chunks"""
         source_hint = None
         try:
-            if isinstance(source, str):
-                source_hint = source
+            if not isinstance(source, Node):
+                if isinstance(source, str):
+                    source_hint = source
                 source = self._parse(source, name, filename)
             source = self._generate(source, name, filename)
-            with open('output.py', 'w') as f:
-                f.write(source)
+            if raw:
+                return source
             if filename is None:
                 filename = '<template>'
             rv = self._compile(source, filename)
@@ -77,21 +281,201 @@ class Environment:
     def _compile(self, source, filename):
         return compile(source, filename, 'exec')
 
+    def compile_many(self, sources, max_workers=None, chunksize=8):
+        """Compiles a mapping of template names to sources in a pool of
+        processes. Returns a `(codes, errors)` tuple of dicts keyed by
+        template name, a failing template doesn't abort the batch.
+        Compiled templates are stored in the bytecode cache if there's one"""
+        return self._compile_many([(name, source, None) for name, source
+                                    in dict(sources).items()],
+                                    max_workers, chunksize)
+
+    def _compile_many(self, items, max_workers=None, chunksize=8):
+        codes = {}
+        errors = {}
+        if not items:
+            return codes, errors
+        names, sources, filenames = zip(*items)
+        options = dict(self.compile_options())
+        with ProcessPoolExecutor(max_workers) as executor:
+            for name, data, error in executor.map(
+                    _compile_worker, repeat(options), names, sources,
+                    filenames, chunksize=chunksize):
+                if error is None:
+                    codes[name] = marshal.loads(data)
+                else:
+                    errors[name] = TemplateError(error)
+
+        bcc = self.bytecode_cache
+        if bcc is not None:
+            for name, source, filename in items:
+                if name in codes:
+                    bucket = bcc.get_bucket(self, name, filename, source)
+                    bucket.code = codes[name]
+                    bcc.set_bucket(bucket)
+        return codes, errors
+
+    def compile_bundle(self, target, names=None, max_workers=None):
+        """Compiles the loader's templates (or the given `names`) into a
+        single bundle file for a `BundleLoader`. Returns a dict of the
+        templates that failed to compile"""
+        from loaders import write_bundle
+        if names is None:
+            names = self.loader.list_templates()
+        items = []
+        for name in names:
+            source, filename, _ = self.loader.get_source(self, name)
+            items.append((name, source, filename))
+        codes, errors = self._compile_many(items, max_workers)
+        write_bundle(target, codes)
+        return errors
+
+    def warm_up(self, names=None, max_workers=None, chunksize=8):
+        """Compiles the loader's templates (or the given `names`) in
+        parallel and puts them into the template cache. Returns a dict of
+        the templates that failed to compile"""
+        if names is None:
+            names = self.loader.list_templates()
+        items = []
+        uptodates = {}
+        for name in names:
+            source, filename, uptodate = self.loader.get_source(self, name)
+            items.append((name, source, filename))
+            uptodates[name] = uptodate
+        codes, errors = self._compile_many(items, max_workers, chunksize)
+        self._install_codes(codes, uptodates, errors)
+        return errors
+
+    def preload(self, names=None, freeze=True):
+        """Compiles the loader's templates (or the given `names`) ahead of
+        forking worker processes. Preloaded templates are served from a
+        plain dict without freshness checks or LRU bookkeeping, so workers
+        don't write to the pages holding them. With `freeze` the garbage
+        collector moves every object alive into its permanent generation
+        so collections in the workers don't dirty them either"""
+        if names is None:
+            names = self.loader.list_templates()
+        preloaded = {}
+        for name in names:
+            preloaded[name] = self.get_template(name)
+        self.preloaded = preloaded
+        if freeze:
+            gc.collect()
+            gc.freeze()
+        return preloaded
+
+    def _install_codes(self, codes, uptodates=None, errors=None):
+        """Puts compiled templates into the template cache, parents are
+        installed before the templates extending them so linking doesn't
+        compile them a second time. Templates that fail to link, extend
+        each other or whose parent failed are skipped and added to
+        `errors`"""
+        if uptodates is None:
+            uptodates = {}
+        if errors is None:
+            errors = {}
+        namespaces = dict((name, self.template_class._exec_code(self, code))
+                        for name, code in codes.items())
+        installed = {}
+
+        def install(name):
+            if name in installed:
+                return installed[name]
+            # marked before the parent is installed, so templates
+            # extending each other don't recurse forever
+            installed[name] = None
+            namespace = namespaces[name]
+            parent = namespace.get('extends')
+            if parent is not None and parent in namespaces:
+                install(parent)
+            if parent in errors:
+                errors[name] = TemplateError('parent template %r failed: %s'
+                                             % (parent, errors[parent]))
+                return None
+            if parent in installed and installed[parent] is None:
+                errors[name] = TemplateError('template %r extends itself '
+                                             'through %r' % (name, parent))
+                return None
+            try:
+                t = self.template_class._from_namespace(self, namespace)
+            except Exception as e:
+                errors[name] = TemplateError('%s: %s' % (e.__class__.__name__,
+                                                         e))
+                return None
+            t._uptodate = uptodates.get(name)
+            t.code = codes[name]
+            if self.cache is not None:
+                self.cache[(self.loader, name)] = t
+            installed[name] = t
+            return t
+
+        for name in namespaces:
+            install(name)
+        return dict((name, t) for name, t in installed.items()
+                    if t is not None)
+
+    def compile_templates(self, target, names=None, py_compile=False,
+                        ignore_errors=True, log_function=None):
+        """Writes every template of the loader (or the given `names`) as a
+        python module into the `target` directory, to be loaded through a
+        `ModuleLoader`. With `py_compile` the bytecode is written as well"""
+        from loaders import ModuleLoader
+        if log_function is None:
+            log_function = lambda x: None
+        if names is None:
+            names = self.loader.list_templates()
+        os.makedirs(target, exist_ok=True)
+
+        written = []
+        for name in names:
+            try:
+                source, filename, _ = self.loader.get_source(self, name)
+                code = self.compile(source, name, filename, raw=True)
+                if code is None:
+                    raise TemplateError('template could not be compiled')
+            except Exception as e:
+                if not ignore_errors:
+                    raise
+                log_function('Could not compile "%s": %s' % (name, e))
+                continue
+            module = os.path.join(target,
+                                ModuleLoader.get_module_filename(name))
+            with open(module, 'w', encoding='utf-8') as f:
+                f.write('# %s\n' % name)
+                f.write(code)
+            if py_compile:
+                import py_compile as pyc
+                pyc.compile(module, doraise=True)
+            log_function('Compiled "%s" as %s' % (name, module))
+            written.append(name)
+        return written
+
 
 class Template:
-    def __new__(cls, source, autoescape=False):
-        env = Environment(autoescape)
+    def __new__(cls, source, autoescape=False, trim_blocks=False,
+                lstrip_blocks=False, minify_html=False):
+        env = get_spontaneous_environment(autoescape=autoescape,
+                                          trim_blocks=trim_blocks,
+                                          lstrip_blocks=lstrip_blocks,
+                                          minify_html=minify_html)
         return env.from_string(source)
     
     @classmethod
-    def from_code(cls, environment, code):
+    def from_code(cls, environment, code, uptodate=None):
+        namespace = cls._exec_code(environment, code)
+        rv = cls._from_namespace(environment, namespace)
+        rv._uptodate = uptodate
+        rv.code = code
+        return rv
+
+    @staticmethod
+    def _exec_code(environment, code):
         namespace = {
             'environment': environment,
             '__file__': code.co_filename
         }
         exec(code, namespace)
-        rv = cls._from_namespace(environment, namespace)
-        return rv
+        return namespace
 
     @classmethod
     def _from_namespace(cls, environment, namespace):
@@ -101,11 +485,24 @@ class Template:
         t.filename = namespace['__file__']
         t.blocks = namespace['blocks']
         t.root_render_func = namespace['root']
+        t.columnar = namespace.get('columnar')
+        t.code = None
+        t.parent = None
+        extends = namespace.get('extends')
+        if extends is not None:
+            # link against the parent chain once so renders don't walk it
+            t.parent = environment.get_template(extends)
+            t.blocks = dict(t.parent.blocks, **t.blocks)
+            t.root_render_func = t.parent.root_render_func
+        t._uptodate = None
+        t._last_checked = time.monotonic()
         namespace['environment'] = environment
         namespace['__minja_template__'] = t
         return t
 
     def render(self, *args, **kwargs):
+        if self.environment.is_async:
+            return asyncio.run(self.render_async(*args, **kwargs))
         vars = dict(*args, **kwargs)
         try:
             ctx = self.new_context(vars)
@@ -113,5 +510,248 @@ class Template:
         except Exception:
             raise
 
+    def render_many(self, contexts, workers=None, processes=None):
+        """Renders the template once per mapping in `contexts`, yielding
+        the results in order. The mappings are used as they are, and the
+        state shared by all renders is set up once. With `workers` the
+        renders are spread over that many threads, which pays off when
+        template callables wait on I/O, with `processes` they go to a
+        `RenderPool` of that many processes"""
+        if self.environment.is_async:
+            raise RuntimeError('render_many is not available in async mode')
+        if processes is not None:
+            return self._render_processes(contexts, processes)
+        render = self._render_func()
+        if workers is None:
+            return map(render, contexts)
+        return self._render_threaded(render, contexts, workers)
+
+    def _render_processes(self, contexts, processes):
+        from renderpool import RenderPool
+        with RenderPool(self.environment, [self], processes) as pool:
+            yield from pool.render(self.name, contexts)
+
+    def render_columns(self, columns):
+        """Renders the template once per row of `columns`, a mapping of
+        names to equally long sequences such as lists or numpy arrays,
+        and returns the list of rendered rows. Templates whose output only
+        depends on plain names are evaluated a whole column at a time,
+        anything else falls back to rendering row by row"""
+        columns = dict(columns)
+        lengths = set(map(len, columns.values()))
+        if len(lengths) > 1:
+            raise ValueError('columns must all have the same length')
+        rows = lengths.pop() if lengths else 0
+
+        plan = self.columnar
+        if plan is None or any(is_name and value not in columns
+                                for is_name, value in plan):
+            names = list(columns)
+            return list(self.render_many(dict(zip(names, values)) for values
+                                        in zip(*columns.values())))
+
+        autoescape = self.environment.autoescape
+        segments = []
+        for is_name, value in plan:
+            if not is_name:
+                segments.append(repeat(value, rows))
+                continue
+            segments.append(_format_column(columns[value], autoescape))
+        if not segments:
+            return [''] * rows
+        return list(map(concat, zip(*segments)))
+
+    def _render_func(self):
+        environment = self.environment
+        name = self.name
+        blocks = self.blocks
+        root = self.root_render_func
+        eval_ctx = EvalContext(environment, name)
+
+        def render(vars):
+            return concat(root(Context(environment, vars, name, blocks,
+                                    eval_ctx)))
+        return render
+
+    def _render_threaded(self, render, contexts, workers):
+        # keep a bounded number of renders in flight instead of
+        # submitting every context up front
+        with ThreadPoolExecutor(workers) as executor:
+            pending = deque()
+            for vars in contexts:
+                pending.append(executor.submit(render, vars))
+                if len(pending) >= workers * 4:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def generate(self, *args, **kwargs):
+        """Iterator over the chunks of the rendered template"""
+        vars = dict(*args, **kwargs)
+        ctx = self.new_context(vars)
+        return self.root_render_func(ctx)
+
+    def stream(self, *args, **kwargs):
+        """Returns a `TemplateStream` rendering the template lazily"""
+        return TemplateStream(self.generate(*args, **kwargs))
+
+    def render_block(self, name, *args, **kwargs):
+        """Renders only the block `name`, the root of the template isn't
+        executed"""
+        if self.environment.is_async:
+            return asyncio.run(self.render_block_async(name, *args, **kwargs))
+        return concat(self.generate_block(name, *args, **kwargs))
+
+    def generate_block(self, name, *args, **kwargs):
+        block = self._get_block(name)
+        vars = dict(*args, **kwargs)
+        return block(self.new_context(vars))
+
+    def stream_block(self, name, *args, **kwargs):
+        """Returns a `TemplateStream` rendering only the block `name`"""
+        return TemplateStream(self.generate_block(name, *args, **kwargs))
+
+    async def render_block_async(self, name, *args, **kwargs):
+        if not self.environment.is_async:
+            raise RuntimeError('The environment was not created with '
+                            'async mode enabled.')
+        block = self._get_block(name)
+        vars = dict(*args, **kwargs)
+        ctx = self.new_context(vars)
+        return concat([event async for event in block(ctx)])
+
+    def _get_block(self, name):
+        try:
+            return self.blocks[name]
+        except KeyError:
+            raise TemplateRuntimeError('template %r has no block %r' %
+                                    (self.name, name))
+
+    async def render_async(self, *args, **kwargs):
+        """Renders a template compiled with `enable_async`, awaiting
+        the awaitables returned by callables"""
+        if not self.environment.is_async:
+            raise RuntimeError('The environment was not created with '
+                            'async mode enabled.')
+        vars = dict(*args, **kwargs)
+        ctx = self.new_context(vars)
+        return concat([event async for event in self.root_render_func(ctx)])
+
+    async def generate_async(self, *args, **kwargs):
+        """Async iterator over the rendered template's chunks"""
+        if not self.environment.is_async:
+            raise RuntimeError('The environment was not created with '
+                            'async mode enabled.')
+        vars = dict(*args, **kwargs)
+        ctx = self.new_context(vars)
+        async for event in self.root_render_func(ctx):
+            yield event
+
     def new_context(self, vars=None):
-        return new_context(self.environment, self.name, self.blocks, vars)
\ No newline at end of file
+        return new_context(self.environment, self.name, self.blocks, vars)
+
+    @property
+    def is_up_to_date(self):
+        """False if the template or one of its parents changed since
+        it was loaded"""
+        if self.parent is not None and not self.parent.is_up_to_date:
+            return False
+        if self._uptodate is None:
+            return True
+        now = time.monotonic()
+        if now - self._last_checked < self.environment.check_interval:
+            return True
+        self._last_checked = now
+        return self._uptodate()
+
+
+def _write_vectored(write, buffers):
+    """Writes all `buffers` with a vectored write function that may
+    write partially, like `os.writev` or `socket.sendmsg`"""
+    while buffers:
+        written = write(buffers)
+        while buffers and written >= len(buffers[0]):
+            written -= len(buffers[0])
+            del buffers[0]
+        if written:
+            buffers[0] = memoryview(buffers[0])[written:]
+
+
+class TemplateStream:
+    def __init__(self, gen):
+        """Wraps a render generator, coalescing the many small strings it
+        yields into chunks of about `buffer_size` characters"""
+        self._gen = gen
+        self.enable_buffering(DEFAULT_STREAM_BUFFER_SIZE)
+
+    def enable_buffering(self, size=DEFAULT_STREAM_BUFFER_SIZE):
+        if size <= 1:
+            raise ValueError('buffer size too small')
+        self.buffered = True
+        self._next = self._buffered_generator(size).__next__
+        return self
+
+    def disable_buffering(self):
+        self.buffered = False
+        self._next = self._gen.__next__
+        return self
+
+    def _buffered_generator(self, size):
+        buffer = []
+        push = buffer.append
+        buffered = 0
+        for item in self._gen:
+            push(item)
+            buffered += len(item)
+            if buffered >= size:
+                yield concat(buffer)
+                buffer.clear()
+                buffered = 0
+        if buffer:
+            yield concat(buffer)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._next()
+
+    def _encoded_batches(self, encoding, errors):
+        batch = []
+        for chunk in self:
+            batch.append(chunk.encode(encoding, errors))
+            if len(batch) >= STREAM_WRITE_BATCH:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def dump(self, fp, encoding='utf-8', errors='strict'):
+        """Writes the stream to a filename or file object. Binary files
+        backed by a file descriptor receive batches of chunks through
+        `os.writev`, text files get the chunks written as they are"""
+        if isinstance(fp, str):
+            with open(fp, 'wb') as f:
+                return self.dump(f, encoding, errors)
+        if hasattr(fp, 'encoding'):
+            fp.writelines(self)
+            return
+        try:
+            fd = fp.fileno()
+        except (AttributeError, OSError, ValueError):
+            for batch in self._encoded_batches(encoding, errors):
+                fp.writelines(batch)
+            return
+        fp.flush()
+        write = lambda buffers: os.writev(fd, buffers)
+        for batch in self._encoded_batches(encoding, errors):
+            _write_vectored(write, batch)
+
+    def write_to(self, sock, encoding='utf-8', errors='strict'):
+        """Sends the stream over a socket, batching chunks into single
+        `sendmsg` calls"""
+        for batch in self._encoded_batches(encoding, errors):
+            _write_vectored(sock.sendmsg, batch)
+
+
+Environment.template_class = Template
\ No newline at end of file
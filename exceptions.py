@@ -32,4 +32,12 @@ class TemplateRuntimeError(TemplateError):
 
 
 class UndefinedError(TemplateRuntimeError):
-    """Raised if a template tries to operator on :class:`Undefined`."""
\ No newline at end of file
+    """Raised if a template tries to operator on :class:`Undefined`."""
+
+class TemplateNotFound(LookupError, TemplateError):
+    """Raised if a loader can't find a template."""
+    def __init__(self, name, message=None):
+        if message is None:
+            message = name
+        TemplateError.__init__(self, message)
+        self.name = name
@@ -0,0 +1,120 @@
+import os
+import time
+import struct
+import tempfile
+from hashlib import sha1
+
+from utils import LRUCache, chmod_default
+
+# default number of fragments kept by a `MemoryFragmentCache`
+DEFAULT_CAPACITY = 1000
+
+_expires = struct.Struct('<d')
+
+
+class FragmentCache:
+    """Base class for the stores behind the `{% cache %}` tag. Keys are
+    tuples of the template name, a checksum of the template and the
+    options it was compiled with, the tag's line and the key expression"""
+
+    def get(self, key):
+        """Returns the cached fragment or None"""
+        raise NotImplementedError()
+
+    def set(self, key, value, timeout=None):
+        """Caches `value` for `timeout` seconds, forever if it's None"""
+        raise NotImplementedError()
+
+    def clear(self):
+        """Removes every cached fragment"""
+
+
+class MemoryFragmentCache(FragmentCache):
+    """Keeps fragments in an in-process LRU cache"""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self._cache = LRUCache(capacity)
+
+    def get(self, key):
+        item = self._cache.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires is not None and expires < time.monotonic():
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        expires = None
+        if timeout:
+            expires = time.monotonic() + timeout
+        self._cache[key] = (value, expires)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class FileSystemFragmentCache(FragmentCache):
+    """Stores fragments as files shared by every process using the same
+    directory. It defaults to a new private directory in /dev/shm where
+    available, which keeps the fragments in shared memory and is shared
+    by the workers forked after the cache was created"""
+
+    def __init__(self, directory=None, pattern='__minja_fragment_%s'):
+        if directory is None:
+            shm = '/dev/shm'
+            if not os.path.isdir(shm):
+                shm = None
+            directory = tempfile.mkdtemp(prefix='minja-fragments-', dir=shm)
+        self.directory = directory
+        self.pattern = pattern
+
+    def _get_filename(self, key):
+        digest = sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, self.pattern % digest)
+
+    def get(self, key):
+        try:
+            with open(self._get_filename(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) < _expires.size:
+            return None
+        expires, = _expires.unpack_from(data)
+        if expires and expires < time.time():
+            return None
+        return data[_expires.size:].decode('utf-8')
+
+    def set(self, key, value, timeout=None):
+        expires = 0.0
+        if timeout:
+            expires = time.time() + timeout
+        filename = self._get_filename(key)
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(filename) + '.',
+                                   dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_expires.pack(expires))
+                f.write(value.encode('utf-8'))
+            chmod_default(tmp)
+            os.replace(tmp, filename)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def clear(self):
+        from fnmatch import fnmatch
+        pattern = self.pattern % '*'
+        for filename in os.listdir(self.directory):
+            if fnmatch(filename, pattern):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
@@ -0,0 +1,346 @@
+"""Recompiles templates that are edited in place, like the live preview of
+an editor, without lexing, parsing and compiling all of the source again
+on every change"""
+from bisect import bisect_right
+
+import nodes
+import tokens
+from lexer import TemplateSyntaxError, newline_re, BLOCK_START_STRING, \
+     BLOCK_END_STRING, COMMENT_START_STRING, COMMENT_END_STRING, \
+     VARIABLE_START_STRING, VARIABLE_END_STRING
+from parser import Parser
+from compiler import CodeGenerator, template_checksum
+from minifier import minify
+
+# statements with a body that is closed by an `end` tag
+_body_statements = frozenset(['for', 'if', 'with', 'block', 'cache'])
+_item_tokens = frozenset([tokens.DATA, tokens.VARIABLE_BEGIN,
+                          tokens.COMMENT_BEGIN, tokens.BLOCK_BEGIN])
+# an edit this close to the start or end of an item can change a
+# whitespace modifier that strips the neighbouring data
+_modifier_reach = 2
+
+
+def _find_blocks(body):
+    for node in body:
+        if isinstance(node, nodes.Block):
+            yield node
+        yield from node.find_all(nodes.Block)
+
+
+class Segment:
+    """A top level item of a template: data, an output, a comment or a
+    statement with its body. The line numbers of `nodes` lag `shift`
+    lines behind until they are needed. `state` is where the HTML is
+    after the segment when the data is minified"""
+    __slots__ = ('lineno', 'nodes', 'shift', 'cached', 'state')
+
+    def __init__(self, lineno, body):
+        self.lineno = lineno
+        self.nodes = body
+        self.shift = 0
+        self.state = None
+        self.cached = any(isinstance(node, nodes.Cache) or
+                          node.find(nodes.Cache) is not None
+                          for node in body)
+
+    def catch_up(self):
+        if self.shift:
+            for node in self.nodes:
+                node.shift_lineno(self.shift)
+            self.shift = 0
+
+
+class IncrementalTemplate:
+    """Keeps the source, the top level segments and the module namespace
+    of a template. `edit` re-lexes and re-parses only the top level
+    statements an edit touches and recompiles only the root and block
+    functions they affect. Offsets refer to the source with newlines
+    normalized to `\\n`"""
+
+    def __init__(self, environment, source, name=None, filename=None):
+        if '\r' in source:
+            source = newline_re.sub('\n', source)
+        self.environment = environment
+        self.name = name
+        self.filename = filename or '<template>'
+        self.source = source
+        self.pending = None
+        self.starts, self.segments = self._parse(0, len(source), 1)
+        if environment.minify_html:
+            self._minify(self.segments, None)
+        self._compile_all()
+
+    def _scan(self, text):
+        """Returns `(offset, lineno, is_comment)` for every top level item"""
+        rv = []
+        depth = 0
+        statement = False
+        for lineno, token, value, offset in \
+                self.environment.lexer.tokenizer(text):
+            if statement:
+                statement = False
+                if token == tokens.NAME:
+                    if value in _body_statements:
+                        depth += 1
+                    elif value[:3] == 'end' and value[3:] in _body_statements:
+                        depth -= 1
+            elif token in _item_tokens:
+                if depth == 0:
+                    rv.append((offset, lineno,
+                               token == tokens.COMMENT_BEGIN))
+                statement = token == tokens.BLOCK_BEGIN
+        return rv
+
+    def _context(self, lo, hi):
+        """Returns comments to wrap `source[lo:hi]` in so the whitespace
+        of its data is stripped like in the whole source: the first one
+        ends like the tag in front of the region, the last one starts
+        like the tag after it"""
+        source = self.source
+        prefix = suffix = ''
+        if lo and source[lo - 1] != '\n':
+            if source.endswith(('-' + BLOCK_END_STRING,
+                                '-' + COMMENT_END_STRING,
+                                '-' + VARIABLE_END_STRING), 0, lo):
+                modifier = '-'
+            elif source.endswith((BLOCK_END_STRING, COMMENT_END_STRING),
+                                 0, lo) and source[lo - 3:lo - 2] != '+':
+                modifier = ''
+            else:
+                modifier = '+'
+            prefix = '%s+ %s%s' % (COMMENT_START_STRING, modifier,
+                                   COMMENT_END_STRING)
+        if hi < len(source):
+            start = source[hi:hi + 2]
+            modifier = source[hi + 2:hi + 3]
+            if start not in (BLOCK_START_STRING, COMMENT_START_STRING,
+                             VARIABLE_START_STRING):
+                modifier = '+'
+            elif modifier not in ('-', '+'):
+                modifier = '' if start != VARIABLE_START_STRING else '+'
+            suffix = '%s%s +%s' % (COMMENT_START_STRING, modifier,
+                                   COMMENT_END_STRING)
+        return prefix, suffix
+
+    def _parse(self, lo, hi, lineno):
+        """Parses `source[lo:hi]` which starts in line `lineno`, returns
+        the offsets and segments of its items"""
+        prefix, suffix = self._context(lo, hi)
+        text = prefix + self.source[lo:hi] + suffix
+        stop = len(text) - len(suffix)
+        offset = lo - len(prefix)
+        items = self._scan(text)
+        if suffix and items[-1][0] != stop:
+            # an unfinished tag of the region swallowed the suffix
+            raise TemplateSyntaxError('unexpected end of template')
+        items = [item for item in items if len(prefix) <= item[0] < stop]
+        body = Parser(self.environment, text).parse().body
+        shift = lineno - 1
+        if shift:
+            for node in body:
+                node.shift_lineno(shift)
+        if len(body) != sum(1 for item in items if not item[2]):
+            # the nodes can't be told apart, keep the region in one piece
+            return [lo], [Segment(lineno, body)]
+        starts = []
+        segments = []
+        body = iter(body)
+        for item_offset, item_lineno, is_comment in items:
+            starts.append(offset + item_offset)
+            segments.append(Segment(item_lineno + shift,
+                                    [] if is_comment else [next(body)]))
+        if lo == 0 and starts:
+            # whitespace stripped in front of the first item belongs to it
+            starts[0] = 0
+            segments[0].lineno = lineno
+        return starts, segments
+
+    def edit(self, start, end, text):
+        """Replaces `source[start:end]` with `text` and returns the
+        recompiled template. If the source is broken after the edit the
+        error is raised and the next edits retry the broken part"""
+        if '\r' in text:
+            text = newline_re.sub('\n', text)
+        source = self.source
+        delta = len(text) - (end - start)
+        line_delta = text.count('\n') - source.count('\n', start, end)
+        self.source = source = source[:start] + text + source[end:]
+
+        starts = self.starts
+        segments = self.segments
+        first = max(bisect_right(starts, start) - 1, 0)
+        if first and start <= starts[first] + _modifier_reach:
+            # the edit could complete a tag the previous item ends with
+            # or strip the data in front of the item
+            first -= 1
+        last = bisect_right(starts, end + _modifier_reach)
+        if delta:
+            starts[last:] = [x + delta for x in starts[last:]]
+        if line_delta:
+            for segment in segments[last:]:
+                segment.lineno += line_delta
+                segment.shift += line_delta
+        if self.pending is not None:
+            idx = segments.index(self.pending)
+            first = min(first, idx)
+            last = max(last, idx + 1)
+
+        # grow the region until it parses on its own
+        step = 1
+        broken = first, last
+        tag_start_char = self.environment.lexer.tag_start_char
+        while True:
+            lo = starts[first] if first < len(starts) else 0
+            is_last = last >= len(starts)
+            hi = len(source) if is_last else starts[last]
+            if not is_last and source[hi - 1:hi] == tag_start_char:
+                last += 1
+                continue
+            lineno = segments[first].lineno if first < len(segments) else 1
+            try:
+                new_starts, new_segments = self._parse(lo, hi, lineno)
+            except Exception:
+                if first == 0 and is_last:
+                    self._set_pending(*broken)
+                    raise
+                first = max(first - step, 0)
+                last = min(last + step, len(starts))
+                step *= 2
+                continue
+            if self.environment.minify_html:
+                state = self._minify(new_segments, segments[first - 1].state
+                                     if first else None)
+                if not is_last and state != segments[last - 1].state:
+                    # the data after the region starts in another state
+                    last = len(starts)
+                    continue
+            break
+
+        old = segments[first:last]
+        starts[first:last] = new_starts
+        segments[first:last] = new_segments
+        self.pending = None
+        self._recompile(old, new_segments, first + len(new_segments),
+                        line_delta)
+        return self.template
+
+    def _minify(self, segments, state):
+        """Minifies the data of `segments` which start in `state`, see
+        `minifier.minify_data`, and returns the state after them"""
+        for segment in segments:
+            state = segment.state = minify(segment.nodes, state)
+        return state
+
+    def _set_pending(self, first, last):
+        """Merges the segments of a region that failed to parse into one
+        which is parsed again with the next edit"""
+        starts = self.starts
+        segments = self.segments
+        if first < len(segments):
+            pending = Segment(segments[first].lineno, [
+                node for segment in segments[first:last]
+                for node in segment.nodes])
+            for segment in segments[first:last]:
+                segment.catch_up()
+            pending.state = segments[last - 1].state
+            start = starts[first]
+        else:
+            pending = Segment(1, [])
+            start = 0
+        starts[first:last] = [start]
+        segments[first:last] = [pending]
+        self.pending = pending
+
+    def _recompile(self, old, new, after, line_delta):
+        if self.stale:
+            return self._compile_all()
+        old_nodes = [node for segment in old for node in segment.nodes]
+        new_nodes = [node for segment in new for node in segment.nodes]
+        if any(isinstance(node, nodes.Extends) or
+               node.find(nodes.Extends) is not None
+               for node in old_nodes + new_nodes):
+            return self._compile_all()
+
+        old_blocks = [block.name for block in _find_blocks(old_nodes)]
+        new_blocks = list(_find_blocks(new_nodes))
+        changed = set(old_blocks)
+        for name in old_blocks:
+            self.blocks.pop(name, None)
+        for block in new_blocks:
+            if block.name in self.blocks:
+                # let the compiler report it
+                return self._compile_all()
+            self.blocks[block.name] = block
+            changed.add(block.name)
+        # the root only calls top level blocks by name
+        root = not (all(isinstance(node, nodes.Block)
+                        for node in old_nodes + new_nodes) and
+                    old_blocks == [block.name for block in new_blocks])
+
+        # fragment cache keys contain the line of the cache tag
+        if line_delta:
+            for segment in self.segments[after:]:
+                if segment.cached:
+                    segment.catch_up()
+                    changed.update(block.name for block in
+                                   _find_blocks(segment.nodes))
+                    if not all(isinstance(node, nodes.Block)
+                               for node in segment.nodes):
+                        root = True
+
+        if self.static_extends is not None:
+            root = False
+        self._compile_functions(root, changed)
+
+    def _template_node(self):
+        body = []
+        for segment in self.segments:
+            segment.catch_up()
+            body.extend(segment.nodes)
+        return nodes.Template(body, lineno=1)
+
+    def _compile_all(self):
+        environment = self.environment
+        self.stale = True
+        node = self._template_node()
+        self.blocks = dict((block.name, block)
+                           for block in _find_blocks(node.body))
+        source = environment._generate(node, self.name, self.filename)
+        code = environment._compile(source, self.filename)
+        template_class = environment.template_class
+        self.namespace = template_class._exec_code(environment, code)
+        self.static_extends = self.namespace.get('extends')
+        self.template = template_class._from_namespace(environment,
+                                                       self.namespace)
+        self.stale = False
+
+    def _compile_functions(self, root, names):
+        """Compiles the root function if `root` is set and the functions
+        of the blocks in `names` into the existing namespace"""
+        environment = self.environment
+        self.stale = True
+        generator = CodeGenerator(environment, self.name, None)
+        generator.blocks = self.blocks
+        eval_ctx = nodes.EvalContext(environment, self.name)
+        cached = any(segment.cached for segment in self.segments)
+        if root or cached:
+            node = self._template_node()
+        if cached:
+            generator.checksum = template_checksum(node, environment)
+        generator.write_imports()
+        if root:
+            generator.write_root(node, eval_ctx)
+        for name in names:
+            if name in self.blocks:
+                generator.write_block(self.blocks[name], eval_ctx)
+        generator.write_block_table()
+        if root:
+            self.namespace.pop('columnar', None)
+            generator.write_columnar(node, eval_ctx)
+        code = environment._compile(generator.stream.getvalue(),
+                                    self.filename)
+        exec(code, self.namespace)
+        self.template = environment.template_class._from_namespace(
+            environment, self.namespace)
+        self.stale = False
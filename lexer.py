@@ -1,6 +1,6 @@
 import re
+import codecs
 from sys import intern
-from collections import deque
 
 import tokens
 
@@ -12,6 +12,9 @@ COMMENT_END_STRING = '#}'
 VARIABLE_START_STRING = '{{'
 VARIABLE_END_STRING = '}}'
 
+# characters read at once from file sources
+DEFAULT_CHUNK_SIZE = 1 << 16
+
 operators = {
     '+':    tokens.ADD,
     '-':    tokens.SUB,
@@ -53,14 +56,72 @@ operator_re = re.compile('|'.join(re.escape(o) for o in
 
 ignored_tokens = set([tokens.WHITESPACE, tokens.COMMENT, 
                         tokens.COMMENT_BEGIN, tokens.COMMENT_END])
-ignore_if_empty = set([tokens.DATA, tokens.COMMENT, tokens.WHITESPACE])
+closing_brackets = {
+    '{': '}',
+    '[': ']',
+    '(': ')'
+}
+closing_bracket_chars = frozenset(closing_brackets.values())
+tag_end_tokens = frozenset([tokens.BLOCK_END, tokens.VARIABLE_END])
+
+def read_chunks(source, chunk_size, encoding='utf-8'):
+    """Reads a file object or mmap in chunks of text with normalized
+    newlines, bytes are decoded incrementally. A trailing carriage
+    return is held back until it's known whether a newline follows"""
+    decoder = None
+    pending = ''
+    while True:
+        data = source.read(chunk_size)
+        chunk = data
+        if isinstance(data, bytes):
+            if decoder is None:
+                decoder = codecs.getincrementaldecoder(encoding)()
+            chunk = decoder.decode(data, not data)
+        chunk = pending + chunk
+        pending = ''
+        if data and chunk.endswith('\r'):
+            pending = '\r'
+            chunk = chunk[:-1]
+        if '\r' in chunk:
+            chunk = newline_re.sub('\n', chunk)
+        if chunk:
+            yield chunk
+        if not data:
+            return
+
 
-class Failure(Exception): pass
 class TemplateSyntaxError(Exception): pass
 
-def raise_if_failure(obj):
-    if isinstance(obj, Failure):
-        raise obj
+
+def compile_master_rule(rules):
+    """Compiles `(regex, token)` rules into one alternation and returns it
+    with a list mapping the index of each rule's group to its token"""
+    regex = re.compile('|'.join('(?P<%s>%s)' % (token, rule.pattern)
+                                for rule, token in rules), re.M | re.S)
+    group_tokens = [None] * (regex.groups + 1)
+    for rule, token in rules:
+        group_tokens[regex.groupindex[token]] = token
+    return regex, group_tokens
+
+
+_parsed_tests = {}
+
+
+def parse_test(expr):
+    """Splits a test expression like `name:value` or `name` into a
+    `(type, value)` tuple, the value is `None` if any value matches.
+    Results are cached so every expression is only split once"""
+    try:
+        return _parsed_tests[expr]
+    except KeyError:
+        pass
+    if ':' in expr:
+        type, value = expr.split(':', 1)
+        rv = intern(type), value
+    else:
+        rv = intern(expr), None
+    _parsed_tests[expr] = rv
+    return rv
 
 
 class Token:
@@ -79,9 +140,8 @@ class Token:
     
     def test(self, expr):
         """Compares expressions like `name:value` or `name` with the token"""
-        if ':' in expr:
-            return expr == '{0}:{1}'.format(self.type, self.value)
-        return self.type == expr
+        type, value = parse_test(expr)
+        return self.type == type and (value is None or self.value == value)
 
 
 class TokenStreamIterator:
@@ -103,59 +163,77 @@ class TokenStreamIterator:
 
 class TokenStream:
     def __init__(self, generator):
-        """A token stream with `.current` as the current active token"""
-        self._iter = generator
-        self._pushed = deque()
-        self.current = Token(0, tokens.INITIAL, '')
-        self.closed = False
-        next(self)
+        """A token stream over `(lineno, type, value)` tuples, stored as
+        parallel lists. `.type`, `.value` and `.lineno` describe the
+        current token, `.current` wraps them in a `Token`"""
+        self.types = types = []
+        self.values = values = []
+        self.linenos = linenos = []
+        add_type = types.append
+        add_value = values.append
+        add_lineno = linenos.append
+        lineno = 0
+        for lineno, type, value in generator:
+            add_lineno(lineno)
+            add_type(type)
+            add_value(value)
+        add_lineno(lineno)
+        add_type(tokens.EOF)
+        add_value('')
+        self.eof = len(types) - 1
+        self.pos = 0
+        self.lineno = linenos[0]
+        self.type = types[0]
+        self.value = values[0]
 
     def __next__(self):
         """Returns the the current token and moves on to the next one"""
-        if self.closed:
-            return self.current
         rv = self.current
-        if self._pushed:
-            self.current = self._pushed.popleft()
-        else:
-            try:
-                self.current = next(self._iter)
-            except StopIteration:
-                self.close()
+        self.skip()
         return rv
 
     def __iter__(self):
         return TokenStreamIterator(self)
 
+    @property
+    def current(self):
+        return Token(self.lineno, self.type, self.value)
+
+    @property
+    def closed(self):
+        return self.pos == self.eof
+
+    def skip(self, n=1):
+        """Moves `n` tokens ahead without creating token objects"""
+        pos = min(self.pos + n, self.eof)
+        self.pos = pos
+        self.lineno = self.linenos[pos]
+        self.type = self.types[pos]
+        self.value = self.values[pos]
+
+    def test(self, expr):
+        """Compares expressions like `name:value` or `name` with the
+        current token"""
+        type, value = parse_test(expr)
+        return self.type == type and (value is None or self.value == value)
+
     def expect(self, expr):
-        """Tests the current with `expr` using `token.test(expr)`"""
-        assert self.current.test(expr), 'expected %r got %r' % (expr, self.current.type)
-        return next(self)
+        """Tests the current token with `expr` and skips it"""
+        assert self.test(expr), 'expected %r got %r' % (expr, self.type)
+        self.skip()
 
     def skip_if(self, expr):
-        if self.current.test(expr):
-            next(self)
+        if self.test(expr):
+            self.skip()
             return True
         return False
 
-    def push(self, token):
-        self._pushed.append(token)
-
-    def look(self):
-        old_token = next(self)
-        rv = self.current
-        self.push(rv)
-        self.current = old_token
-        return rv
+    def look(self, n=1):
+        """Returns the type of the token `n` positions ahead"""
+        return self.types[min(self.pos + n, self.eof)]
 
     def close(self):
-        self.current = Token(self.current.lineno, tokens.EOF, '')
-        self._iter = None
-        self.closed = True
-
-    @property
-    def lineno(self):
-        return self.current.lineno
+        self.skip(self.eof - self.pos)
 
 
 class Lexer:
@@ -163,150 +241,255 @@ class Lexer:
         e = re.escape
         c = lambda x: re.compile(x, re.M | re.S)
         self.environment = environment
+        self.trim_blocks = getattr(environment, 'trim_blocks', False)
+        self.lstrip_blocks = getattr(environment, 'lstrip_blocks', False)
 
-        # tag lexing rules
+        # tag lexing rules, floats go before integers so `1.5` isn't
+        # lexed as `1`, `.`, `5`
         self.tag_rules = [
-            (name_re, tokens.NAME, None),
-            (string_re, tokens.STRING, None),
-            (integer_re, tokens.INTEGER, None),
-            (float_re, tokens.FLOAT, None),
-            (operator_re, tokens.OPERATOR, None),
-            (whitespace_re, tokens.WHITESPACE, None),
-        ]
-
-        # root lexing rules
-        self.root_tag_rules = [
-            ('block', r'%s' % e(BLOCK_START_STRING)),
-            ('comment', r'%s' % e(COMMENT_START_STRING)),
-            ('variable', r'%s' % e(VARIABLE_START_STRING)),
+            (name_re, tokens.NAME),
+            (string_re, tokens.STRING),
+            (float_re, tokens.FLOAT),
+            (integer_re, tokens.INTEGER),
+            (operator_re, tokens.OPERATOR),
+            (whitespace_re, tokens.WHITESPACE),
         ]
 
-        # directives
-        # latest_match: [(regex, regex_groups, new_state)]
-        self.rules = {
-            'root': [
-                (c('(.*?)(?:%s)' % '|'.join(
-                    [r'(?P<%s_begin>%s)' % (n, r) 
-                        for n, r in self.root_tag_rules]
-                        )), (tokens.DATA, '#bygroup'), '#bygroup'),
-                (c('.+'), tokens.DATA, None)
-            ],
-            tokens.COMMENT_BEGIN: [
-                (c(r'(.*?)(%s)' % e(COMMENT_END_STRING)),
-                    (tokens.COMMENT, tokens.COMMENT_END), '#pop'),
-                (c(r'(.+)'), Failure('Expected %s' % tokens.COMMENT_END), None)
-            ],
-            tokens.BLOCK_BEGIN: [
-                (c(r'(%s)' % e(BLOCK_END_STRING)), tokens.BLOCK_END, '#pop')
-            ] + self.tag_rules,
-            tokens.VARIABLE_BEGIN: [
-                (c(r'(%s)' % e(VARIABLE_END_STRING)), tokens.VARIABLE_END, '#pop')
-            ] + self.tag_rules,
+        # outside of tags only the character following a `{` decides
+        # whether a tag starts, all start strings share that first char
+        self.tag_start_char = BLOCK_START_STRING[0]
+        self.root_tags = {}
+        for start, token in ((BLOCK_START_STRING, tokens.BLOCK_BEGIN),
+                            (COMMENT_START_STRING, tokens.COMMENT_BEGIN),
+                            (VARIABLE_START_STRING, tokens.VARIABLE_BEGIN)):
+            assert len(start) == 2 and start[0] == self.tag_start_char
+            self.root_tags[start[1]] = token
+        # a `-` next to the delimiters of a tag strips the whitespace on
+        # that side, a `+` turns off lstrip_blocks or trim_blocks for it
+        self.comment_re = c(r'(.*?)([-+]?%s)' % e(COMMENT_END_STRING))
+
+        # every tag state is lexed with a single regex, one named group
+        # per rule. While brackets are open the end of the tag can't
+        # match, `}}` is lexed as operators instead
+        self.tag_states = {
+            tokens.BLOCK_BEGIN: compile_master_rule(
+                [(c(r'[-+]?' + e(BLOCK_END_STRING)), tokens.BLOCK_END)] +
+                self.tag_rules),
+            tokens.VARIABLE_BEGIN: compile_master_rule(
+                [(c(r'-?' + e(VARIABLE_END_STRING)), tokens.VARIABLE_END)] +
+                self.tag_rules),
         }
+        self.bracket_state = compile_master_rule(self.tag_rules)
     
     def tokenize(self, source):
         """Returns a TokenStream"""
         stream_generator = self.tokenizer(source)
-        # for t in self.wrap(stream_generator):
-        #     print(t)
         return TokenStream(self.wrap(stream_generator))
 
-    def tokenizer(self, source):
-        source = '\n'.join(source.splitlines())
+    def tokenizer(self, source, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Yields `(lineno, token, value, offset)` tuples where `offset`
+        is the position of the token in the source, whitespace inside of
+        tags is skipped. `source` is a string or a file object or mmap,
+        which is read in chunks of `chunk_size` so only the unfinished
+        part of a chunk is kept around"""
+        if isinstance(source, str):
+            # newlines are normalized only if needed
+            if '\r' in source:
+                source = newline_re.sub('\n', source)
+            chunks = iter(())
+        else:
+            chunks = read_chunks(source, chunk_size)
+            source = ''
         lineno = 1
-        pos = 0
-        stack = ['root']
-        current_rule = self.rules[stack[-1]]
-        brackets_stack = []
-
-        while 1:
-            for regex, group_tokens, next_state in current_rule:
-                m = regex.match(source, pos)
-                if not m:
-                    continue
-                
-                # if there's a bracket mismatch, we continue scanning
-                # with the operator rule instead of processing the _end token
-                if brackets_stack and group_tokens in (tokens.BLOCK_END, 
-                    tokens.COMMENT_END, tokens.VARIABLE_END):
-                    # print('skippin')
+        pos = end = base = 0
+        eof = False
+        more = True
+        # whitespace to strip in front of the next data, set by the end
+        # of a tag: `-` strips all of it, trim_blocks the first newline
+        strip = None
+        trim_blocks = self.trim_blocks
+        lstrip_blocks = self.lstrip_blocks
+        tag_start_char = self.tag_start_char
+        root_tags = self.root_tags
+        comment_match = self.comment_re.match
+        tag_states = self.tag_states
+        bracket_re, bracket_tokens = self.bracket_state
+        bracket_match = bracket_re.match
+        whitespace_match = whitespace_re.match
+        DATA = tokens.DATA
+        OPERATOR = tokens.OPERATOR
+        WHITESPACE = tokens.WHITESPACE
+        STRING = tokens.STRING
+        BLOCK_END = tokens.BLOCK_END
+        COMMENT_BEGIN = tokens.COMMENT_BEGIN
+
+        while True:
+            if more:
+                # drop what was lexed and append the next chunk, the last
+                # lexed char is kept to tell if a tag starts a line. A
+                # single trailing newline is ignored by stopping short
+                chunk = next(chunks, None)
+                if chunk is None:
+                    eof = True
+                else:
+                    cut = pos and pos - 1
+                    source = source[cut:] + chunk
+                    base += cut
+                    pos -= cut
+                end = len(source)
+                if eof and source.endswith('\n'):
+                    end -= 1
+                more = False
+
+            if strip is not None and pos < end:
+                if strip == '-':
+                    # the whitespace may go on in the next chunk
+                    m = whitespace_match(source, pos, end)
+                    if m is not None:
+                        lineno += m.group().count('\n')
+                        pos = m.end()
+                    if pos < end or eof:
+                        strip = None
+                else:
+                    # trim_blocks is done once the first char was seen
+                    if source[pos] == '\n':
+                        lineno += 1
+                        pos += 1
+                    strip = None
+            if pos >= end:
+                if eof:
+                    return
+                more = True
+                continue
+
+            # jump from one `{` to the next until one starts a tag
+            find = source.find
+            idx = find(tag_start_char, pos, end - 1)
+            while idx != -1:
+                state = root_tags.get(source[idx + 1])
+                if state is not None:
+                    break
+                idx = find(tag_start_char, idx + 1, end - 1)
+            if idx == -1:
+                if eof:
+                    yield lineno, DATA, source[pos:end], base + pos
+                    return
+                # the last char could start a tag and trailing whitespace
+                # could be stripped by it
+                data = source[pos:end - 1].rstrip()
+                if data:
+                    yield lineno, DATA, data, base + pos
+                    lineno += data.count('\n')
+                    pos += len(data)
+                more = True
+                continue
+            modifier = source[idx + 2:idx + 3]
+            if not modifier and not eof:
+                more = True
+                continue
+
+            if idx > pos:
+                data = source[pos:idx]
+                lines = data.count('\n')
+                if modifier == '-':
+                    data = data.rstrip()
+                elif (lstrip_blocks and modifier != '+' and
+                      state is not tokens.VARIABLE_BEGIN):
+                    # strip the indentation of a tag that starts a line
+                    stripped = data.rstrip(' \t')
+                    if stripped.endswith('\n') or not stripped and (
+                            base + pos == 0 or source[pos - 1] == '\n'):
+                        data = stripped
+                if data:
+                    yield lineno, DATA, data, base + pos
+                lineno += lines
+                pos = idx
+            tag_pos = pos + 2
+            if modifier in '-+':
+                tag_pos += 1
+
+            if state is COMMENT_BEGIN:
+                m = comment_match(source, tag_pos, end)
+                if m is None:
+                    if eof:
+                        raise TemplateSyntaxError('expected %s in line %d' %
+                                                (tokens.COMMENT_END, lineno))
+                    more = True
                     continue
+                yield lineno, state, source[pos:tag_pos], base + pos
+                comment = m.group(1)
+                yield lineno, tokens.COMMENT, comment, base + tag_pos
+                lineno += comment.count('\n')
+                value = m.group(2)
+                yield lineno, tokens.COMMENT_END, value, base + m.start(2)
+                pos = m.end()
+                if value[0] == '-':
+                    strip = '-'
+                elif trim_blocks and value[0] != '+':
+                    strip = '\n'
+                continue
 
-                if isinstance(group_tokens, tuple):
-                    for idx, token in enumerate(group_tokens):
-                        raise_if_failure(token)
-                        # bygroups are resolved through match group names
-                        if token == '#bygroup':
-                            for k, v in m.groupdict().items():
-                                if v is not None:
-                                    yield lineno, k, v
-                                    lineno += v.count('\n')
-                                    break
-                            else:
-                                raise RuntimeError("couldn't resolve bygroup" 
-                                    "dynamically in line %d" % lineno)
-                        else:
-                            # yield normal data as is
-                            data = m.group(idx + 1)
-                            if data or token not in ignore_if_empty:
-                                yield lineno, token, data
-                            lineno += data.count('\n')
+            # a tag is lexed as a whole and lexed again once more of the
+            # source is read if it runs into the end of the chunk
+            tag_re, tag_tokens = tag_states[state]
+            tag_match = tag_re.match
+            tag_lineno = lineno
+            brackets_stack = []
+            rv = [(lineno, state, source[pos:tag_pos], base + pos)]
+            while tag_pos < end:
+                if brackets_stack:
+                    m = bracket_match(source, tag_pos, end)
+                    token = m and bracket_tokens[m.lastindex]
                 else:
-                    raise_if_failure(group_tokens)
-                    data = m.group()
-                    closing_brackets = {
-                        '{': '}',
-                        '[': ']',
-                        '(': ')'
-                    }
+                    m = tag_match(source, tag_pos, end)
+                    token = m and tag_tokens[m.lastindex]
+                if m is None or (m.end() == end and not eof):
+                    if not eof:
+                        more = True
+                        break
+                    raise TemplateSyntaxError('unexpected char %s in line %d'
+                                            % (source[tag_pos], lineno))
+                value = m.group()
+                tag_pos = m.end()
+                if token is WHITESPACE:
+                    lineno += value.count('\n')
+                    continue
+                if token is OPERATOR:
                     # validate bracket pairs
-                    if group_tokens == 'operator':
-                        if data in closing_brackets:
-                            brackets_stack.append(closing_brackets[data])
-                        elif data in closing_brackets.values():
-                            if not brackets_stack:
-                                raise TemplateSyntaxError('unexpected character %s'
-                                    ' in line %d' % (data, lineno))
-
-                            expected_ch = brackets_stack.pop()
-                            if data != expected_ch:
-                                raise TemplateSyntaxError('expected %s instead of'
-                                    ' %s in line %d' % (expected_ch, data, lineno))
-
-                    if data or group_tokens not in ignore_if_empty:
-                        yield lineno, group_tokens, data
-                    lineno += data.count('\n')
-                # handle the next state
-                pos2 = m.end()
-                if next_state is not None:
-                    if next_state == '#pop':
-                        stack.pop()
-                    elif next_state == '#bygroup':
-                        for k, v in m.groupdict().items():
-                            if v is not None:
-                                stack.append(k)
-                                break
-                        else:
-                            raise RuntimeError("couldn't resolve bygroup" 
-                                "dynamically in line %s" % lineno)
-                    else:
-                        stack.append(next_state)
-                    current_rule = self.rules[stack[-1]]
-                # we have not moved forward
-                elif pos2 == pos:
-                    raise RuntimeError("%r couldn't match any strings" % regex)
-                pos = pos2
-                break
-            # if we didn't break out, we're at the eof or in an error state
+                    if value in closing_brackets:
+                        brackets_stack.append(closing_brackets[value])
+                    elif value in closing_bracket_chars:
+                        if not brackets_stack:
+                            raise TemplateSyntaxError('unexpected character '
+                                '%s in line %d' % (value, lineno))
+                        expected_ch = brackets_stack.pop()
+                        if value != expected_ch:
+                            raise TemplateSyntaxError('expected %s instead of'
+                                ' %s in line %d' % (expected_ch, value, lineno))
+                rv.append((lineno, token, value, base + m.start()))
+                if token is STRING:
+                    lineno += value.count('\n')
+                elif token in tag_end_tokens:
+                    if value[0] == '-':
+                        strip = '-'
+                    elif (trim_blocks and token is BLOCK_END and
+                          value[0] != '+'):
+                        strip = '\n'
+                    break
             else:
-                if pos >= len(source):
-                    return
-                raise TemplateSyntaxError('unexpected char %s in line %d' % (source[pos], lineno))
+                if not eof:
+                    more = True
+            if more:
+                lineno = tag_lineno
+                strip = None
+                continue
+            yield from rv
+            pos = tag_pos
 
     def wrap(self, stream_generator):
-        """Returns a generator wrapping the tokens returned by
-        `tokenizer` as `Token` instances"""
-        for lineno, token, value in stream_generator:
+        """Returns a generator converting the values of the tokens
+        returned by `tokenizer` and dropping ignored ones"""
+        for lineno, token, value, offset in stream_generator:
             if token in ignored_tokens:
                 continue
             elif token == tokens.OPERATOR:
@@ -317,4 +500,4 @@ class Lexer:
                 value = float(value)
             elif token == tokens.STRING:
                 value = value[1:-1]
-            yield Token(lineno, token, value)
\ No newline at end of file
+            yield lineno, token, value
\ No newline at end of file
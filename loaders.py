@@ -0,0 +1,194 @@
+import os
+import mmap
+import struct
+import marshal
+import tempfile
+from hashlib import sha1
+from importlib.util import spec_from_file_location
+
+from bccache import bc_magic
+from utils import chmod_default
+from exceptions import TemplateNotFound
+
+# bundle layout: magic, index size, marshalled index, marshalled code objects
+bundle_magic = b'MJB' + bc_magic
+_index_size = struct.Struct('<Q')
+
+
+def split_template_path(template):
+    """Splits a template name into path segments, refusing names that
+    would escape the search path"""
+    pieces = []
+    for piece in template.split('/'):
+        if (os.path.sep in piece
+            or (os.path.altsep and os.path.altsep in piece)
+            or piece == os.path.pardir):
+            raise TemplateNotFound(template)
+        elif piece and piece != '.':
+            pieces.append(piece)
+    return pieces
+
+
+class BaseLoader:
+    """Base class for loaders. Subclasses implement `get_source` which
+    returns a `(source, filename, uptodate)` tuple, `uptodate` being a
+    callable that returns False once the template changed or None"""
+
+    def get_source(self, environment, template):
+        raise TemplateNotFound(template)
+
+    def list_templates(self):
+        raise TypeError('this loader cannot iterate over all templates')
+
+    def load(self, environment, name):
+        source, filename, uptodate = self.get_source(environment, name)
+        code = environment.load_code(source, name, filename)
+        return environment.template_class.from_code(environment, code,
+                                                    uptodate)
+
+
+class FileSystemLoader(BaseLoader):
+    """Loads templates from one or more directories"""
+
+    def __init__(self, searchpath, encoding='utf-8'):
+        if isinstance(searchpath, str):
+            searchpath = [searchpath]
+        self.searchpath = list(searchpath)
+        self.encoding = encoding
+
+    def get_source(self, environment, template):
+        pieces = split_template_path(template)
+        for searchpath in self.searchpath:
+            filename = os.path.join(searchpath, *pieces)
+            try:
+                f = open(filename, 'rb')
+            except OSError:
+                continue
+            with f:
+                st = os.fstat(f.fileno())
+                contents = f.read().decode(self.encoding)
+            signature = (st.st_mtime_ns, st.st_size)
+
+            def uptodate():
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    return False
+                return (st.st_mtime_ns, st.st_size) == signature
+
+            return contents, filename, uptodate
+        raise TemplateNotFound(template)
+
+    def list_templates(self):
+        found = set()
+        for searchpath in self.searchpath:
+            for dirpath, _, filenames in os.walk(searchpath):
+                for filename in filenames:
+                    template = os.path.join(dirpath, filename)[
+                        len(searchpath):].strip(os.path.sep)
+                    found.add(template.replace(os.path.sep, '/'))
+        return sorted(found)
+
+
+class ModuleLoader(BaseLoader):
+    """Loads templates precompiled by `Environment.compile_templates`.
+    The modules are imported directly so python's own bytecode caching
+    applies and templates are never lexed, parsed or compiled"""
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def get_template_key(name):
+        return 'tmpl_' + sha1(name.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_module_filename(name):
+        return ModuleLoader.get_template_key(name) + '.py'
+
+    def load(self, environment, name):
+        key = self.get_template_key(name)
+        filename = os.path.join(self.path, key + '.py')
+        if not os.path.isfile(filename):
+            raise TemplateNotFound(name)
+        # the module's code is executed in a fresh namespace bound to the
+        # environment, python's import machinery supplies cached bytecode
+        spec = spec_from_file_location(key, filename)
+        code = spec.loader.get_code(key)
+        return environment.template_class.from_code(environment, code)
+
+
+def write_bundle(filename, codes):
+    """Writes a dict of template names to code objects as one bundle file.
+    The file is replaced atomically so processes that still map the old
+    bundle keep working"""
+    index = {}
+    blobs = []
+    offset = 0
+    for name in sorted(codes):
+        blob = marshal.dumps(codes[name])
+        index[name] = (offset, len(blob))
+        blobs.append(blob)
+        offset += len(blob)
+    header = marshal.dumps(index)
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(bundle_magic)
+            f.write(_index_size.pack(len(header)))
+            f.write(header)
+            for blob in blobs:
+                f.write(blob)
+        chmod_default(tmp)
+        os.replace(tmp, filename)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class BundleLoader(BaseLoader):
+    """Loads templates from a bundle written by `write_bundle`. The file
+    is memory mapped, so preforked workers share one copy through the
+    page cache, and a template is only unmarshalled when it's first
+    requested"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._mmap = None
+        self._index = None
+        self._data_offset = None
+
+    def _open(self):
+        with open(self.filename, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = len(bundle_magic)
+        if mapping[:offset] != bundle_magic:
+            mapping.close()
+            raise ValueError('%r is not a bundle of this minja and python '
+                            'version' % self.filename)
+        size, = _index_size.unpack_from(mapping, offset)
+        offset += _index_size.size
+        self._index = marshal.loads(mapping[offset:offset + size])
+        self._data_offset = offset + size
+        self._mmap = mapping
+
+    def list_templates(self):
+        if self._mmap is None:
+            self._open()
+        return sorted(self._index)
+
+    def load(self, environment, name):
+        if self._mmap is None:
+            self._open()
+        try:
+            offset, size = self._index[name]
+        except KeyError:
+            raise TemplateNotFound(name)
+        offset += self._data_offset
+        code = marshal.loads(self._mmap[offset:offset + size])
+        return environment.template_class.from_code(environment, code)
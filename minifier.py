@@ -0,0 +1,93 @@
+"""Minifies the HTML in the static data of a template while it is
+compiled, so every render emits less without post-processing"""
+import re
+
+import nodes
+
+# elements whose content is whitespace sensitive or not HTML
+RAW_ELEMENTS = ('pre', 'textarea', 'script', 'style')
+
+# the start of a comment, of a raw element or of any other tag
+_markup_re = re.compile(r'<(?:(!--)|(%s)\b|(?=[a-zA-Z/!?]))'
+                        % '|'.join(RAW_ELEMENTS), re.I)
+_raw_end_res = dict((name, re.compile(r'</%s\s*>' % name, re.I))
+                    for name in RAW_ELEMENTS)
+_tag_re = re.compile(r'[>"\']')
+_whitespace_re = re.compile(r'\s+')
+
+
+def _collapse(text):
+    return _whitespace_re.sub(' ', text)
+
+
+def minify_data(data, state=None):
+    """Minifies a piece of HTML. `state` tells where the piece starts: in
+    text if it's None, in a comment (`'<!--'`), a tag (`'<'`), a quoted
+    attribute value (the quote) or a raw element (its name). Returns the
+    minified data and the state at its end"""
+    rv = []
+    pos = 0
+    while pos < len(data):
+        if state is None:
+            m = _markup_re.search(data, pos)
+            if m is None:
+                rv.append(_collapse(data[pos:]))
+                break
+            rv.append(_collapse(data[pos:m.start()]))
+            pos = m.end()
+            if m.group(1):
+                end = data.find('-->', pos)
+                # conditional comments of old IE versions are kept, so
+                # are comments which go on after this piece
+                if end != -1 and not data.startswith('[if', pos):
+                    pos = end + 3
+                    continue
+                state = '<!--'
+            elif m.group(2):
+                state = m.group(2).lower()
+            else:
+                state = '<'
+            rv.append(m.group())
+        elif state == '<!--':
+            end = data.find('-->', pos)
+            if end == -1:
+                rv.append(data[pos:])
+                break
+            rv.append(data[pos:end + 3])
+            pos = end + 3
+            state = None
+        elif state == '<':
+            m = _tag_re.search(data, pos)
+            if m is None:
+                rv.append(_collapse(data[pos:]))
+                break
+            rv.append(_collapse(data[pos:m.end()]))
+            pos = m.end()
+            state = None if m.group() == '>' else m.group()
+        elif state == '"' or state == "'":
+            # attribute values are kept as they are
+            end = data.find(state, pos)
+            if end == -1:
+                rv.append(data[pos:])
+                break
+            rv.append(data[pos:end + 1])
+            pos = end + 1
+            state = '<'
+        else:
+            m = _raw_end_res[state].search(data, pos)
+            if m is None:
+                rv.append(data[pos:])
+                break
+            rv.append(data[pos:m.end()])
+            pos = m.end()
+            state = None
+    return ''.join(rv), state
+
+
+def minify(body, state=None):
+    """Minifies the `TemplateData` below the nodes of `body` in source
+    order and returns the state after them"""
+    for node in body:
+        for data in node.find_all(nodes.TemplateData):
+            data.body, state = minify_data(data.body, state)
+    return state
@@ -1,7 +1,7 @@
 import operator
 from collections import deque
 
-from utils import concat
+from utils import concat, Markup
 
 _binop_to_func = {
     '*':        operator.mul,
@@ -113,7 +113,17 @@ class Node:
                 node.ctx = ctx
                 todo.extend(node.iter_child_nodes())
         return self
-    
+
+    def shift_lineno(self, offset):
+        """Moves the line numbers of the node and its children by `offset`"""
+        todo = deque([self])
+        while todo:
+            node = todo.popleft()
+            if 'lineno' in node.__dict__:
+                node.lineno += offset
+            todo.extend(node.iter_child_nodes())
+        return self
+
     def as_const(self, eval_ctx=None):
         raise Impossible()
 
@@ -144,6 +154,10 @@ class For(Stmt):
 class Block(Stmt):
     fields = ('name', 'body')
 
+class Cache(Stmt):
+    """Output of `body` is cached under `key` for `timeout` seconds"""
+    fields = ('key', 'timeout', 'body')
+
 class Expr(Node):
     def as_const(self, eval_ctx=None):
         raise Impossible()
@@ -155,6 +169,8 @@ class TemplateData(Literal):
     fields = ('body',)
 
     def as_const(self, eval_ctx=None):
+        if eval_ctx is not None and eval_ctx.autoescape:
+            return Markup(self.body)
         return self.body
 
 class Const(Literal):
@@ -190,7 +206,7 @@ class Dict(Literal):
 
     def as_const(self, eval_ctx=None):
         eval_ctx = get_eval_ctx(self, eval_ctx)
-        return dict(x.as_const() for x in self.items)
+        return dict(x.as_const(eval_ctx) for x in self.items)
 
 class Name(Expr):
     fields = ('name', 'ctx')
@@ -260,7 +276,8 @@ class BinExpr(Expr):
         eval_ctx = get_eval_ctx(self, eval_ctx)
         f = _binop_to_func[self.operator]
         try:
-            f(self.left.as_const(eval_ctx), self.right.as_const(eval_ctx))
+            return f(self.left.as_const(eval_ctx),
+                     self.right.as_const(eval_ctx))
         except Exception:
             raise Impossible()
 
@@ -282,7 +299,7 @@ class Sub(BinExpr):
     operator = '-'
 
 class Mul(BinExpr):
-    operator = '+'
+    operator = '*'
 
 class Div(BinExpr):
     operator = '/'
@@ -318,3 +335,43 @@ class Neg(UnaryExpr):
 
 class Pos(UnaryExpr):
     operator = '+'
+
+
+# node classes by name for `load`
+_node_types = dict((name, obj) for name, obj in list(globals().items())
+                   if isinstance(obj, type) and issubclass(obj, Node))
+
+
+def _dump_value(value):
+    if isinstance(value, Node):
+        return dump(value)
+    if isinstance(value, list):
+        return [_dump_value(item) for item in value]
+    return value
+
+
+def dump(node):
+    """Returns the tree of `node` as tagged tuples of the class name, the
+    line number and the fields, which `marshal` can serialize"""
+    return (node.__class__.__name__, node.__dict__.get('lineno')) + tuple(
+        _dump_value(getattr(node, name, None)) for name in node.fields)
+
+
+def _load_value(value):
+    if isinstance(value, tuple):
+        return load(value)
+    if isinstance(value, list):
+        return [_load_value(item) for item in value]
+    return value
+
+
+def load(data):
+    """Builds the tree returned by `dump` again"""
+    cls = _node_types[data[0]]
+    node = cls.__new__(cls)
+    attributes = node.__dict__
+    if data[1] is not None:
+        attributes['lineno'] = data[1]
+    for name, value in zip(cls.fields, data[2:]):
+        attributes[name] = _load_value(value)
+    return node
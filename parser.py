@@ -3,16 +3,39 @@ import tokens
 from lexer import reversed_operators
 from utils import concat
 
-_statement_keywords = ('for', 'with', 'if', 'block', 'extends')
-_compare_operators = ('eq', 'neq', 'geq', 'leq', 'gt', 'lt')
-_math_nodes = {
-    tokens.ADD:       nodes.Add,
-    tokens.SUB:       nodes.Sub,
-    tokens.MUL:       nodes.Mul,
-    tokens.DIV:       nodes.Div,
-    tokens.FLOOR_DIV: nodes.FloorDiv,
-    tokens.POW:       nodes.Pow
+_statement_keywords = ('for', 'with', 'if', 'block', 'extends', 'cache')
+
+# binding strength of the expression operators, a higher one binds tighter
+_or_precedence = 1
+_and_precedence = 2
+_not_precedence = 3
+_compare_precedence = 4
+# binary operators keyed on their token type or, for keyword operators, on
+# the name. Comparisons have no node class as they are chained into one
+# `Compare` node
+_binary_operators = {
+    tokens.EQ:        (_compare_precedence, None),
+    tokens.NE:        (_compare_precedence, None),
+    tokens.GT:        (_compare_precedence, None),
+    tokens.GTEQ:      (_compare_precedence, None),
+    tokens.LT:        (_compare_precedence, None),
+    tokens.LTEQ:      (_compare_precedence, None),
+    tokens.ADD:       (5, nodes.Add),
+    tokens.SUB:       (5, nodes.Sub),
+    tokens.MUL:       (6, nodes.Mul),
+    tokens.DIV:       (6, nodes.Div),
+    tokens.FLOOR_DIV: (6, nodes.FloorDiv),
+    tokens.MOD:       (6, nodes.Mod),
+    tokens.POW:       (7, nodes.Pow)
 }
+_binary_keywords = {
+    'or':             (_or_precedence, nodes.Or),
+    'and':            (_and_precedence, nodes.And),
+    'in':             (_compare_precedence, None),
+    'not':            (_compare_precedence, None)
+}
+_compare_tokens = frozenset(token_type for token_type, (_, cls)
+                            in _binary_operators.items() if cls is None)
 
 class Parser:
     def __init__(self, environment, source):
@@ -26,11 +49,11 @@ class Parser:
         assert lineno is False
 
     def is_tuple_end(self, extra_end_rules=None):
-        if self.token_stream.current.type in (tokens.VARIABLE_END, 
+        if self.token_stream.type in (tokens.VARIABLE_END, 
             tokens.BLOCK_END, tokens.RPAREN):
             return True
         if extra_end_rules is not None:
-            return any(map(self.token_stream.current.test, extra_end_rules))
+            return any(map(self.token_stream.test, extra_end_rules))
         return False
 
     def parse_statements(self, end_tokens=None, drop_needle=True):
@@ -39,28 +62,29 @@ class Parser:
         if self.token_stream.closed:
             self.fail('unexpected end of file', self.token_stream.lineno)
         if drop_needle:
-            next(self.token_stream)
+            self.token_stream.skip()
         return rv
 
     def parse_statement(self):
-        token = self.token_stream.current
-        if token.type != tokens.NAME:
-            self.fail('tag name expected', token.lineno)
+        if self.token_stream.type != tokens.NAME:
+            self.fail('tag name expected', self.token_stream.lineno)
 
-        if token.value in _statement_keywords:
-            method = 'parse_' + token.value.lower()
+        if self.token_stream.value in _statement_keywords:
+            method = 'parse_' + self.token_stream.value.lower()
             method = getattr(self, method)
             return method()
 
-        self.unknown_tag(token.lineno)
+        self.unknown_tag(self.token_stream.lineno)
 
     def parse_extends(self):
-        lineno = self.token_stream.expect('name:extends').lineno
+        lineno = self.token_stream.lineno
+        self.token_stream.expect('name:extends')
         template = self.parse_expression()
         return nodes.Extends(template, lineno=lineno)
 
     def parse_if(self):
-        node = rv = nodes.If(lineno=self.token_stream.expect('name:if').lineno)
+        node = rv = nodes.If(lineno=self.token_stream.lineno)
+        self.token_stream.expect('name:if')
         while True:
             node.test = self.parse_tuple()
             node.body = self.parse_statements(end_tokens=('name:elif',
@@ -69,48 +93,63 @@ class Parser:
                                                 drop_needle=False)
             node.elif_ = []
             node.else_ = []
-            token = next(self.token_stream)
-            if token.test('name:elif'):
-                node = nodes.If(lineno=token.lineno)
+            lineno = self.token_stream.lineno
+            if self.token_stream.skip_if('name:elif'):
+                node = nodes.If(lineno=lineno)
                 rv.elif_.append(node)
                 continue
-            elif token.test('name:else'):
+            elif self.token_stream.skip_if('name:else'):
                 rv.else_ = self.parse_statements(end_tokens=('name:endif',))
                 break
             else:
+                self.token_stream.skip()
                 break
         return rv
 
     def parse_for(self):
-        lineno = self.token_stream.expect('name:for').lineno
+        lineno = self.token_stream.lineno
+        self.token_stream.expect('name:for')
         target = self.parse_assign_target(extra_end_rules=('name:in',))
         self.token_stream.expect('name:in')
-        iter = self.parse_tuple()
-        body = self.parse_statements(end_tokens=('name:endfor',
-                                                    'name:else'),
-                                                drop_needle=False)
+        iter = self.parse_tuple(extra_end_rules=('name:if',))
         test = None
         if self.token_stream.skip_if('name:if'):
             test = self.parse_expression()
-        token = next(self.token_stream)
-        if token.test('name:else'):
+        body = self.parse_statements(end_tokens=('name:endfor',
+                                                    'name:else'),
+                                                drop_needle=False)
+        if self.token_stream.skip_if('name:else'):
             else_ = self.parse_statements(end_tokens=('name:endfor',))
         else:
+            self.token_stream.skip()
             else_ = []
         return nodes.For(target, iter, body, test, else_, lineno=lineno)
 
     def parse_block(self):
-        lineno = self.token_stream.expect('name:block').lineno
-        name = self.token_stream.expect('name').value
+        lineno = self.token_stream.lineno
+        self.token_stream.expect('name:block')
+        name = self.token_stream.value
+        self.token_stream.expect('name')
         body = self.parse_statements(end_tokens=('name:endblock',))
         self.token_stream.skip_if('name:' + name)
         return nodes.Block(name, body, lineno=lineno)
 
+    def parse_cache(self):
+        lineno = self.token_stream.lineno
+        self.token_stream.expect('name:cache')
+        key = self.parse_expression()
+        timeout = None
+        if self.token_stream.skip_if(tokens.COMMA):
+            timeout = self.parse_expression()
+        body = self.parse_statements(end_tokens=('name:endcache',))
+        return nodes.Cache(key, timeout, body, lineno=lineno)
+
     def parse_with(self):
-        lineno = next(self.token_stream).lineno
+        lineno = self.token_stream.lineno
+        self.token_stream.skip()
         targets = []
         values = []
-        while self.token_stream.current.type is not tokens.BLOCK_END:
+        while self.token_stream.type is not tokens.BLOCK_END:
             if targets:
                 self.token_stream.expect(tokens.COMMA)
             target = self.parse_assign_target()
@@ -131,94 +170,76 @@ class Parser:
         return target
 
     def parse_expression(self):
-        return self.parse_or()
-
-    def parse_or(self):
-        lineno = self.token_stream.lineno
-        left = self.parse_and()
-        while self.token_stream.current.test('name:or'):
-            next(self.token_stream)
-            right = self.parse_and()
-            left = nodes.Or(left, right, lineno)
-            lineno = self.token_stream.lineno
+        return self.parse_binary(0)
+
+    def parse_binary(self, min_precedence):
+        """Parses an expression of the operators that bind tighter than
+        `min_precedence` by precedence climbing. A node gets the line its
+        left operand starts in if it's the first of its operator's
+        precedence, the line of the operator before it otherwise"""
+        stream = self.token_stream
+        start = lineno = stream.lineno
+        if (min_precedence <= _not_precedence and stream.type is tokens.NAME
+                and stream.value == 'not'):
+            stream.skip()
+            left = nodes.Not(self.parse_binary(_not_precedence),
+                             lineno=lineno)
+        elif stream.type is tokens.ADD or stream.type is tokens.SUB:
+            left = self.parse_unary()
+        else:
+            left = self.parse_postfix(self.parse_primary())
+        level = None
+        while True:
+            if stream.type is tokens.NAME:
+                operator = _binary_keywords.get(stream.value)
+            else:
+                operator = _binary_operators.get(stream.type)
+            if operator is None:
+                break
+            precedence, cls = operator
+            if precedence <= min_precedence:
+                break
+            if precedence != level:
+                # operators of a precedence can't follow ones binding
+                # tighter here, those are parsed by the operands
+                level = precedence
+                lineno = start
+            if cls is None:
+                left = self.parse_compare(left, lineno)
+            else:
+                stream.skip()
+                left = cls(left, self.parse_binary(precedence),
+                           lineno=lineno)
+            lineno = stream.lineno
         return left
 
-    def parse_and(self):
-        lineno = self.token_stream.lineno
-        left = self.parse_not()
-        while self.token_stream.current.test('name:and'):
-            next(self.token_stream)
-            right = self.parse_not()
-            left = nodes.And(left, right, lineno)
-            lineno = self.token_stream.lineno
-        return left
-    
-    def parse_not(self):
-        lineno = self.token_stream.lineno
-        if self.token_stream.current.test('name:not'):
-            next(self.token_stream)
-            nodes.Not(self.parse_not(), lineno=lineno)
-        return self.parse_compare()
-    
-    def parse_compare(self):
-        lineno = self.token_stream.lineno
-        expr = self.parse_math1()
+    def parse_compare(self, expr, lineno):
+        stream = self.token_stream
         operands = []
         while True:
-            token_type = self.token_stream.current.type
-            if token_type in _compare_operators:
-                next(self.token_stream)
-                operands.append(nodes.Operand(token_type, self.parse_math1()))
-            elif self.token_stream.skip_if('name:in'):
-                operands.append(nodes.Operand('in', self.parse_math1()))
-            elif self.token_stream.skip_if('name:not'):
-                self.token_stream.expect('name:in')
-                operands.append(nodes.Operand('notin', self.parse_math1()))
+            token_type = stream.type
+            if token_type in _compare_tokens:
+                stream.skip()
+                operator = token_type
+            elif stream.skip_if('name:in'):
+                operator = 'in'
+            elif stream.skip_if('name:not'):
+                stream.expect('name:in')
+                operator = 'notin'
             else:
                 break
-        if not operands:
-            return expr
+            operands.append(nodes.Operand(
+                operator, self.parse_binary(_compare_precedence)))
         return nodes.Compare(expr, operands, lineno=lineno)
 
-    def parse_math1(self):
-        lineno = self.token_stream.lineno
-        left = self.parse_math2()
-        while self.token_stream.current.type in (tokens.ADD, tokens.SUB):
-            cls = _math_nodes[next(self.token_stream).type]
-            right = self.parse_math2()
-            left = cls(left, right, lineno=lineno)
-            lineno = self.token_stream.lineno
-        return left
-
-    def parse_math2(self):
-        lineno = self.token_stream.lineno
-        left = self.parse_pow()
-        while self.token_stream.current.type in (tokens.MUL, tokens.DIV, 
-            tokens.FLOOR_DIV, tokens.MOD):
-            cls = _math_nodes[next(self.token_stream).type]
-            right = self.parse_pow()
-            left = cls(left, right, lineno=lineno)
-            lineno = self.token_stream.lineno
-        return left
-    
-    def parse_pow(self):
-        lineno = self.token_stream.lineno
-        left = self.parse_unary()
-        while self.token_stream.current.type is tokens.POW:
-            next(self.token_stream)
-            right = self.parse_unary()
-            left = nodes.Pow(left, right, lineno)
-            lineno = self.token_stream.lineno
-        return left
-
     def parse_unary(self):
         lineno = self.token_stream.lineno
-        token_type = self.token_stream.current.type
+        token_type = self.token_stream.type
         if token_type is tokens.ADD:
-            next(self.token_stream)
+            self.token_stream.skip()
             node = nodes.Pos(self.parse_unary(), lineno=lineno)
         elif token_type is tokens.SUB:
-            next(self.token_stream)
+            self.token_stream.skip()
             node = nodes.Neg(self.parse_unary(), lineno=lineno)
         else:
             node = self.parse_primary()
@@ -226,36 +247,37 @@ class Parser:
         return node
 
     def parse_primary(self):
-        token = self.token_stream.current
-        lineno = token.lineno
-        if token.value in ('True', 'False'):
-            next(self.token_stream)
-            return nodes.Const(token.value in ('True', 'False'), 
-                            lineno=lineno)
-        elif token.type is tokens.INTEGER:
-            next(self.token_stream)
-            return nodes.Const(int(token.value), lineno=lineno)
-        elif token.type is tokens.FLOAT:
-            next(self.token_stream)
-            return nodes.Const(float(token.value), lineno=lineno)
-        elif token.type is tokens.STRING:
-            buffer = [next(self.token_stream).value]
-            while self.token_stream.current.type is tokens.STRING:
-                buffer.append(next(self.token_stream).value)
+        token_type = self.token_stream.type
+        value = self.token_stream.value
+        lineno = self.token_stream.lineno
+        if token_type is tokens.NAME and value in ('True', 'False'):
+            self.token_stream.skip()
+            return nodes.Const(value == 'True', lineno=lineno)
+        elif token_type is tokens.INTEGER:
+            self.token_stream.skip()
+            return nodes.Const(int(value), lineno=lineno)
+        elif token_type is tokens.FLOAT:
+            self.token_stream.skip()
+            return nodes.Const(float(value), lineno=lineno)
+        elif token_type is tokens.STRING:
+            buffer = []
+            while self.token_stream.type is tokens.STRING:
+                buffer.append(self.token_stream.value)
+                self.token_stream.skip()
             return nodes.Const(concat(buffer), lineno=lineno)
-        elif token.type is tokens.NAME:
-            next(self.token_stream)
-            return nodes.Name(token.value, 'load', lineno=lineno)
-        elif token.type is tokens.LPAREN:
-            next(self.token_stream)
+        elif token_type is tokens.NAME:
+            self.token_stream.skip()
+            return nodes.Name(value, 'load', lineno=lineno)
+        elif token_type is tokens.LPAREN:
+            self.token_stream.skip()
             node = self.parse_tuple(explicit_parens=True)
             self.token_stream.expect(tokens.RPAREN)
-        elif token.type is tokens.LBRACKET:
+        elif token_type is tokens.LBRACKET:
             node = self.parse_list()
-        elif token.type is tokens.LBRACE:
+        elif token_type is tokens.LBRACE:
             node = self.parse_dict()
         else:
-            self.fail('unexpected character %r' % token.value, lineno)
+            self.fail('unexpected character %r' % value, lineno)
         return node
 
     def parse_tuple(self, simplified=False, extra_end_rules=None, explicit_parens=False):
@@ -273,7 +295,7 @@ class Parser:
             if items:
                 self.token_stream.expect(tokens.COMMA)
             items.append(parse())
-            if self.token_stream.current.test(tokens.COMMA):
+            if self.token_stream.test(tokens.COMMA):
                 is_tuple = True
             else:
                 break
@@ -283,44 +305,46 @@ class Parser:
                 return items[0]
 
             if not explicit_parens:
-                self.fail('expected expression for %s' % self.token_stream.current.value,
+                self.fail('expected expression for %s' % self.token_stream.value,
                         self.token_stream.lineno)
 
         return nodes.Tuple(items, 'load', lineno=lineno)
 
     def parse_list(self):
-        lineno = self.token_stream.expect(tokens.LBRACKET).lineno
+        lineno = self.token_stream.lineno
+        self.token_stream.expect(tokens.LBRACKET)
         items = []
         
-        while self.token_stream.current.type is not tokens.RBRACKET:
+        while self.token_stream.type is not tokens.RBRACKET:
             if items:
                 self.token_stream.expect(tokens.COMMA)
-            if self.token_stream.current.type is tokens.RBRACKET:
+            if self.token_stream.type is tokens.RBRACKET:
                 break
             items.append(self.parse_expression())
         self.token_stream.expect(tokens.RBRACKET)
         return nodes.List(items, lineno=lineno)
 
     def parse_dict(self):
-        lineno = self.token_stream.expect(tokens.RBRACE).lineno
+        lineno = self.token_stream.lineno
+        self.token_stream.expect(tokens.LBRACE)
         items = []
 
-        while self.token_stream.current.type is not tokens.RBRACE:
+        while self.token_stream.type is not tokens.RBRACE:
             if items:
                 self.token_stream.expect(tokens.COMMA)
-            if self.token_stream.current.type is tokens.RBRACE:
+            if self.token_stream.type is tokens.RBRACE:
                 break
-            token = self.token_stream.current
+            lineno = self.token_stream.lineno
             key = self.parse_expression()
             self.token_stream.expect(tokens.COLON)
             value = self.parse_expression()
-            items.append(nodes.Pair(key, value, lineno=token.lineno))
+            items.append(nodes.Pair(key, value, lineno=lineno))
         self.token_stream.expect(tokens.RBRACE)
         return nodes.Dict(items, lineno=lineno)
 
     def parse_postfix(self, node):
         while True:
-            token_type = self.token_stream.current.type
+            token_type = self.token_stream.type
             if token_type is tokens.LPAREN:
                 node = self.parse_call(node)
             elif token_type in (tokens.LBRACKET, tokens.DOT):
@@ -330,7 +354,8 @@ class Parser:
         return node
 
     def parse_call(self, node):
-        lineno = self.token_stream.expect(tokens.LPAREN).lineno
+        lineno = self.token_stream.lineno
+        self.token_stream.expect(tokens.LPAREN)
         args = []
         kwargs = []
         dyn_args = dyn_kwargs = None
@@ -340,29 +365,30 @@ class Parser:
             if not test:
                 self.fail('unexpected call arguments', self.token_stream.lineno)
 
-        while self.token_stream.current.type is not tokens.RPAREN:
+        while self.token_stream.type is not tokens.RPAREN:
             if require_comma:
                 self.token_stream.expect(tokens.COMMA)    
-                if self.token_stream.current.type is tokens.RPAREN:
+                if self.token_stream.type is tokens.RPAREN:
                     break
-            token = self.token_stream.current
-            if token.type is tokens.MUL:
+            token_type = self.token_stream.type
+            if token_type is tokens.MUL:
                 ensure(dyn_args is None and dyn_kwargs is None)
-                next(self.token_stream)
+                self.token_stream.skip()
                 dyn_args = self.parse_expression()
-            elif token.type is tokens.POW:
+            elif token_type is tokens.POW:
                 ensure(dyn_kwargs is None)
-                next(self.token_stream)
+                self.token_stream.skip()
                 dyn_kwargs = self.parse_expression()
             else:
                 ensure(dyn_args is None and dyn_kwargs is None)
-                if (token.type is tokens.NAME and 
-                    self.token_stream.look().type is tokens.ASSIGN):
-                    key = next(self.token_stream).value
-                    next(self.token_stream)
+                if (token_type is tokens.NAME and 
+                    self.token_stream.look() is tokens.ASSIGN):
+                    key = self.token_stream.value
+                    key_lineno = self.token_stream.lineno
+                    self.token_stream.skip(2)
                     value = self.parse_expression()
                     kwargs.append(nodes.Keyword(key, value, 
-                                lineno=token.lineno))
+                                lineno=key_lineno))
                 else:
                     ensure(not kwargs)
                     args.append(self.parse_expression())
@@ -372,36 +398,38 @@ class Parser:
                         lineno=lineno)
 
     def parse_subscript(self, node):
-        token = next(self.token_stream)
-        if token.type is tokens.DOT:
-            attr_token = next(self.token_stream)
-            if attr_token.type is tokens.NAME:
-                return nodes.Getattr(node, attr_token.value, 'load', 
-                                    lineno=token.lineno)
-            self.fail('expected name instead of %r' % token.value, 
-                    lineno=token.lineno)
-        elif token.type is tokens.LBRACKET:
+        token_type = self.token_stream.type
+        lineno = self.token_stream.lineno
+        self.token_stream.skip()
+        if token_type is tokens.DOT:
+            if self.token_stream.type is tokens.NAME:
+                attr = self.token_stream.value
+                self.token_stream.skip()
+                return nodes.Getattr(node, attr, 'load', lineno=lineno)
+            self.fail('expected name instead of %r' % self.token_stream.value, 
+                    lineno=lineno)
+        elif token_type is tokens.LBRACKET:
             node = nodes.Getitem(node, self.parse_subscribed(), 'load',
-                                lineno=token.lineno)
+                                lineno=lineno)
             self.token_stream.expect(tokens.RBRACKET)
             return node
-        self.fail('expected subscript character', lineno=token.lineno)
+        self.fail('expected subscript character', lineno=lineno)
 
     def parse_subscribed(self):
         args = []
         expect_arg = True
-        lineno = self.token_stream.current.lineno
+        lineno = self.token_stream.lineno
 
-        while self.token_stream.current.type is not tokens.RBRACKET:
-            token = self.token_stream.current
-            if token.type is tokens.COLON:
+        while self.token_stream.type is not tokens.RBRACKET:
+            if self.token_stream.type is tokens.COLON:
+                self.token_stream.skip()
                 # we were expecting an argument
                 # append None for empty arguments e.g [:10]
                 if expect_arg:
                     args.append(None)
                 # if we're at the end, the last argument is None
                 # e.g [10:]
-                if self.token_stream.current is tokens.RBRACKET:
+                if self.token_stream.type is tokens.RBRACKET:
                     args.append(None)
                 expect_arg = True
                 continue
@@ -413,6 +441,7 @@ class Parser:
             self.fail('empty subscript', lineno=lineno)
         elif len(args) == 1:
             return args[0]
+        args.extend([None] * (3 - len(args)))
         return nodes.Slice(*args, lineno=lineno)
 
     def subparse(self, end_tokens=None):
@@ -426,23 +455,24 @@ class Parser:
             body.append(nodes.Output(buffer[:]))
             buffer.clear()
 
-        def test_end_tokens(token):
+        def test_end_tokens():
             if end_tokens:
-                return any(map(token.test, end_tokens))
+                return any(map(self.token_stream.test, end_tokens))
 
         while not self.token_stream.closed:
-            token = self.token_stream.current
-            if token.type == tokens.DATA:
-                add_data(nodes.TemplateData(token.value, lineno=token.lineno))
-                next(self.token_stream)
-            elif token.type == tokens.VARIABLE_BEGIN:
-                next(self.token_stream)
+            token_type = self.token_stream.type
+            if token_type == tokens.DATA:
+                add_data(nodes.TemplateData(self.token_stream.value,
+                                            lineno=self.token_stream.lineno))
+                self.token_stream.skip()
+            elif token_type == tokens.VARIABLE_BEGIN:
+                self.token_stream.skip()
                 add_data(self.parse_tuple())
                 self.token_stream.expect(tokens.VARIABLE_END)
-            elif token.type == tokens.BLOCK_BEGIN:
+            elif token_type == tokens.BLOCK_BEGIN:
                 flush_data()
-                next(self.token_stream)
-                if test_end_tokens(self.token_stream.current):
+                self.token_stream.skip()
+                if test_end_tokens():
                     return body
                 rv = self.parse_statement()
                 if isinstance(rv, list):
@@ -451,7 +481,8 @@ class Parser:
                     body.append(rv)
                 self.token_stream.expect(tokens.BLOCK_END)
             else:
-                raise AssertionError('unexpected token %r in line %r' % (token.value, token.lineno))
+                raise AssertionError('unexpected token %r in line %r' % (
+                    self.token_stream.value, self.token_stream.lineno))
             flush_data()
 
         return body
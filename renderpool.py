@@ -0,0 +1,94 @@
+import os
+import marshal
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+
+from environment import Environment
+
+# templates installed in a worker process, keyed by name
+_templates = None
+
+
+def _init_worker(options, codes):
+    global _templates
+    env = Environment(**options)
+    _templates = env._install_codes(dict(
+        (name, marshal.loads(data)) for name, data in codes.items()))
+
+
+def _render_chunk(name, contexts):
+    return list(_templates[name].render_many(contexts))
+
+
+def _dump_chunk(name, items):
+    template = _templates[name]
+    for filename, vars in items:
+        template.stream(vars).dump(filename)
+    return [filename for filename, _ in items]
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class RenderPool:
+    def __init__(self, environment, templates, processes=None,
+                chunksize=64):
+        """A pool of processes rendering `templates`, given as names or
+        template objects. The templates and their parents are sent to
+        each worker once as marshalled code, tasks only carry picklable
+        contexts and go out `chunksize` at a time"""
+        codes = {}
+        for template in templates:
+            if isinstance(template, str):
+                template = environment.get_template(template)
+            while template is not None:
+                if template.code is None:
+                    raise ValueError('template %r was not created from a '
+                                    'code object' % template.name)
+                codes[template.name] = marshal.dumps(template.code)
+                template = template.parent
+
+        if processes is None:
+            processes = os.cpu_count() or 1
+        self.processes = processes
+        self.chunksize = chunksize
+        self._executor = ProcessPoolExecutor(
+            processes, initializer=_init_worker,
+            initargs=(dict(environment.compile_options()), codes))
+
+    def _map_chunks(self, func, name, iterable):
+        # a bounded number of chunks is in flight so huge inputs are
+        # consumed lazily
+        pending = deque()
+        for chunk in _chunks(iterable, self.chunksize):
+            pending.append(self._executor.submit(func, name, chunk))
+            if len(pending) >= self.processes * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+    def render(self, name, contexts):
+        """Renders template `name` once per context, yielding the results
+        in order"""
+        return self._map_chunks(_render_chunk, name, contexts)
+
+    def dump(self, name, items):
+        """Renders template `name` into files, `items` are pairs of a
+        filename and a context. Yields the filenames once written"""
+        return self._map_chunks(_dump_chunk, name, items)
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,4 +1,6 @@
-from utils import missing
+from inspect import isawaitable
+
+from utils import missing, concat, escape, Markup
 from nodes import EvalContext
 from exceptions import UndefinedError
 
@@ -11,11 +13,13 @@ def resolve_or_missing(context, key, missing=missing):
 
 
 class Context:
-    def __init__(self, environment, parent, name, blocks):
+    def __init__(self, environment, parent, name, blocks, eval_ctx=None):
         self.parent = parent
         self.vars = {}
         self.environment = environment
-        self.eval_ctx = EvalContext(self.environment, name)
+        if eval_ctx is None:
+            eval_ctx = EvalContext(self.environment, name)
+        self.eval_ctx = eval_ctx
         self.name = name
         self.blocks = dict(blocks)
     
@@ -41,8 +45,8 @@ class Context:
         return rv
 
     def resolve_or_missing(self, key):
-        rv = self.resolve(key)
-        if isinstance(rv, self.environment.undefined):
+        rv = resolve_or_missing(self, key)
+        if rv is not missing and isinstance(rv, self.environment.undefined):
             rv = missing
         return rv
 
@@ -62,11 +66,12 @@ class Context:
                             'StopIteration exception.')
 
 
-def new_context(environment, template_name, blocks, vars=None):
+def new_context(environment, template_name, blocks, vars=None,
+                eval_ctx=None):
     if vars is None:
         vars = {}
     parent = vars
-    return Context(environment, parent, template_name, blocks)
+    return Context(environment, parent, template_name, blocks, eval_ctx)
 
 
 class Undefined:
@@ -113,4 +118,31 @@ class Undefined:
         __float__ = __complex__ = __pow__ = __rpow__ = __sub__ = \
         __rsub__ = fail_with_undefined_error
 
-__all__ = ['missing']
\ No newline at end of file
+def fragment_key(value):
+    """Returns the key of a cache tag as part of a fragment cache key,
+    unhashable values are keyed by their type and repr"""
+    if isinstance(value, Undefined):
+        value.fail_with_undefined_error()
+    try:
+        hash(value)
+    except TypeError:
+        return ('repr', value.__class__.__name__, repr(value))
+    return value
+
+
+async def auto_await(value):
+    if isawaitable(value):
+        return await value
+    return value
+
+
+async def auto_aiter(iterable):
+    if hasattr(iterable, '__aiter__'):
+        async for item in iterable:
+            yield item
+    else:
+        for item in iterable:
+            yield item
+
+__all__ = ['missing', 'concat', 'escape', 'Markup', 'fragment_key',
+           'auto_await', 'auto_aiter']
\ No newline at end of file
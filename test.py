@@ -84,3 +84,57 @@ source = t.render(
     func=lambda x: x,
     d=(1,23,4))
 print(source)
+
+# a bundle written by write_bundle loads back through BundleLoader
+import os
+import tempfile
+from environment import Environment
+from loaders import BundleLoader, write_bundle
+
+with tempfile.TemporaryDirectory() as directory:
+    filename = os.path.join(directory, 'templates.bundle')
+    env = Environment()
+    write_bundle(filename, {'page.html': env.compile(template, 'page.html')})
+    env = Environment(loader=BundleLoader(filename))
+    assert env.loader.list_templates() == ['page.html']
+    assert env.get_template('page.html').render(
+        items=[1, 2, 3, 4], test=t_, obj=A(), func=lambda x: x,
+        d=(1, 23, 4)) == source
+
+# lexing a file object in chunks of any size gives the same data as
+# lexing the string, whitespace control included
+import io
+
+def merged_data(tokens):
+    rv = []
+    for lineno, token, value, offset in tokens:
+        if rv and token == 'data' and rv[-1][1] == 'data':
+            rv[-1] = (rv[-1][0], token, rv[-1][2] + value, rv[-1][3])
+        else:
+            rv.append((lineno, token, value, offset))
+    return rv
+
+whitespace_sources = [
+    '{% if a %}\n\nX{% endif %}',
+    '{% if a %}\n  {{ x }}\n  {%- if b -%}\n\n{% endif %}\n{% endif %}\n',
+    '  {% for i in x %}\n    {#- c #}\n{{ i }}  {%+ if y +%}\n\n{% endif %}',
+]
+for options in [{}, {'trim_blocks': True}, {'lstrip_blocks': True},
+                {'trim_blocks': True, 'lstrip_blocks': True}]:
+    lexer = Environment(**options).lexer
+    for whitespace_source in whitespace_sources:
+        expected = merged_data(lexer.tokenizer(whitespace_source))
+        for size in range(1, len(whitespace_source) + 2):
+            assert merged_data(lexer.tokenizer(
+                io.StringIO(whitespace_source), size)) == expected, \
+                (options, whitespace_source, size)
+
+# minify_html keeps attribute values and raw elements as they are, a
+# comment naming a raw element doesn't stop the minifying after it
+env = Environment(minify_html=True)
+assert env.from_string(
+    '<input value="a   b"  title=\'{{ x }}  \n y\'>\n\n  text   here'
+).render(x=1) == '<input value="a   b" title=\'1  \n y\'> text here'
+assert env.from_string(
+    '<!-- <pre> -->\n  a   b  <pre class="c  d">  e   f </pre>   g'
+).render() == ' a b <pre class="c  d">  e   f </pre> g'
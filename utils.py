@@ -1,3 +1,7 @@
+import os
+from threading import Lock
+from collections import OrderedDict
+
 from markupsafe import Markup, escape
 
 concat = u''.join
@@ -7,3 +11,71 @@ class MissingType:
         return 'missing'
 
 missing = MissingType()
+
+# mkstemp creates files only their owner can read, files written through
+# it get the mode open() would have given them before they're shared
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def chmod_default(filename):
+    os.chmod(filename, 0o666 & ~_umask)
+
+
+class LRUCache:
+    """A thread safe mapping holding at most `capacity` items, evicting
+    the least recently used one when full"""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._mapping = OrderedDict()
+        self._lock = Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._mapping)
+
+    def __contains__(self, key):
+        return key in self._mapping
+
+    def __getitem__(self, key):
+        rv = self.get(key, missing)
+        if rv is missing:
+            raise KeyError(key)
+        return rv
+
+    def __setitem__(self, key, value):
+        mapping = self._mapping
+        with self._lock:
+            mapping[key] = value
+            mapping.move_to_end(key)
+            if len(mapping) > self.capacity:
+                mapping.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                rv = self._mapping[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._mapping.move_to_end(key)
+            self.hits += 1
+            return rv
+
+    def peek(self, key, default=None):
+        """Like `get` without touching the usage order or the counters"""
+        return self._mapping.get(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._mapping.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._mapping),
+            'capacity': self.capacity
+        }